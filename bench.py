@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+
+'''\
+Benchmarks for blog.py
+'''
+
+import sys
+import os
+import time
+import random
+import tempfile
+import shutil
+import json
+import io
+import platform
+from contextlib import redirect_stdout
+from subprocess import check_output, CalledProcessError, DEVNULL
+import threading
+import http.client
+from urllib.parse import urlsplit
+from collections import Counter
+from argparse import ArgumentParser
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+
+import docutils
+
+import blog
+
+
+words = '''\
+lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor
+incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud
+exercitation ullamco laboris nisi aliquip ex ea commodo consequat
+'''.split()
+
+
+def sentence(rng, count):
+    return ' '.join(rng.choice(words) for i in range(count)).capitalize() + '.'
+
+
+def paragraph(rng):
+    kind = rng.randrange(6)
+    if kind == 0:
+        return '\n'.join([
+            '.. code-block:: python',
+            '',
+        ] + ['    ' + sentence(rng, 6) for i in range(8)])
+    elif kind == 1:
+        return '\n'.join('- ' + sentence(rng, 8) for i in range(5))
+    text = ' '.join(sentence(rng, 12) for i in range(6))
+    if kind == 2:
+        text += f' See `{rng.choice(words)} <https://example.com/{rng.choice(words)}>`__.'
+    elif kind == 3:
+        text += f' It has *{rng.choice(words)}* and ``{rng.choice(words)}``.'
+    return text
+
+
+def generate_corpus(dest, posts=1000, years=10, tags=100, tags_per_post=3,
+        paragraphs=40, seed=0):
+    '''\
+    Write a synthetic site's posts in the same format as blog.new_post
+    into dest/posts/<year>/ and return the list of paths.
+    '''
+    rng = random.Random(seed)
+    tag_names = [f'tag {i}' for i in range(tags)]
+    start = datetime(2024 - years, 1, 1, tzinfo=timezone.utc)
+    span = timedelta(days=365 * years)
+    paths = []
+    for i in range(posts):
+        created = start + span * rng.random()
+        published = created + timedelta(hours=rng.randrange(1, 48))
+        title = f'Post {i}: ' + sentence(rng, 4)[:-1]
+        year_path = dest / blog.posts_path / str(published.year)
+        year_path.mkdir(parents=True, exist_ok=True)
+        path = year_path / f'post-{i}.rst'
+        path.write_text('\n'.join([
+            f':created: {created}',
+            f':published: {published}',
+            ':tags: ' + ', '.join(rng.sample(tag_names, tags_per_post)),
+            ':summary: ' + sentence(rng, 8),
+            '',
+            blog.header(title),
+            '',
+            '.. post-info-start',
+            '.. post-info-end',
+            '',
+        ] + [paragraph(rng) + '\n' for p in range(paragraphs)]))
+        paths.append(path)
+    return paths
+
+
+def timed(func, *args, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def report(name, elapsed, baseline=None):
+    line = f'{name:>24}: {elapsed:9.4f} s'
+    if baseline is not None:
+        line += f' ({baseline / elapsed:.1f}x)'
+    print(line)
+
+
+# Post metadata extraction ====================================================
+
+def get_text(arg):
+    rc = []
+    for node in arg:
+        if node.nodeType == node.TEXT_NODE:
+            rc.append(node.data)
+        else:
+            rc.append(get_text(node.childNodes))
+    return ''.join(rc)
+
+
+def asdom_extract_post_info(path, text):
+    # How load_posts used to do it: parse everything and convert to minidom
+    dom = blog.parse_rst(path, text).asdom()
+    title = None
+    for title_node in dom.getElementsByTagName('title'):
+        title = get_text([title_node])
+        break
+    doc_info = {}
+    for field_list in dom.getElementsByTagName('field_list'):
+        for field in field_list.childNodes:
+            name = get_text(field.getElementsByTagName('field_name'))
+            value = get_text(field.getElementsByTagName('field_body'))
+            doc_info[name] = value
+    return title, doc_info
+
+
+def bench_extract(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = generate_corpus(Path(tmp), posts=args.posts, paragraphs=args.paragraphs)
+        texts = [(path, path.read_text()) for path in paths]
+        size = sum(len(text) for path, text in texts)
+        print(f'{len(texts)} posts, {size / len(texts) / 1024:.1f} KiB average')
+
+        def run(extract):
+            return [extract(path, text) for path, text in texts]
+
+        old_time, old_result = timed(run, asdom_extract_post_info, repeat=args.repeat)
+        report('asdom', old_time)
+        new_time, new_result = timed(run, blog.extract_post_info, repeat=args.repeat)
+        report('extract_post_info', new_time, old_time)
+        if old_result != new_result:
+            sys.exit('ERROR: extract_post_info results differ from asdom')
+
+
+# Year and tag indexes ========================================================
+
+def synthetic_posts(posts=50000, years=20, tags=500, tags_per_post=3, seed=0):
+    # A Blog without any files behind it
+    rng = random.Random(seed)
+    site = blog.Blog()
+    tag_names = [f'tag {i}' for i in range(tags)]
+    start = datetime(2024 - years, 1, 1, tzinfo=timezone.utc)
+    span = timedelta(days=365 * years)
+    for i in range(posts):
+        published = start + span * rng.random()
+        site.add_post(Path(f'posts/{published.year}/post-{i}.rst'), f'Post {i}', {
+            'created': str(published),
+            'published': str(published),
+            'tags': ', '.join(rng.sample(tag_names, tags_per_post)),
+            'summary': 'Summary',
+        })
+    return site
+
+
+def scan_queries(site):
+    # How generate_blog used to get its post lists: a filter and two sorts
+    # over every post for each query.
+    def get_sorted(posts, year=None, reverse=True):
+        if year is not None:
+            posts = filter(lambda p: p.dt().year == year, posts)
+        posts = sorted(posts, key=lambda p: p.title)
+        return sorted(posts, key=lambda p: p.dt(), reverse=reverse)
+
+    posts = site.posts
+    years = set()
+    for post in posts:
+        years |= {post.dt().year}
+    return (
+        get_sorted(posts)[:5],
+        [get_sorted(posts, year=year, reverse=False) for year in sorted(years, reverse=True)],
+        [get_sorted(tag.posts) for tag in site.tags.values()],
+    )
+
+
+def index_queries(site):
+    site.index = None
+    return list_queries(site)
+
+
+def list_queries(site):
+    return (
+        site.get_sorted()[:5],
+        [site.get_sorted(year=year, reverse=False)
+            for year in sorted(site.get_years(), reverse=True)],
+        [site.get_sorted(tag=tag) for tag in site.tags.values()],
+    )
+
+
+def bench_index(args):
+    site = synthetic_posts(posts=args.posts, years=args.years, tags=args.tags)
+    print(f'{len(site.posts)} posts, {len(site.tags)} tags')
+    old_time, old_result = timed(scan_queries, site, repeat=args.repeat)
+    report('full scans', old_time)
+    new_time, new_result = timed(index_queries, site, repeat=args.repeat)
+    report('PostIndex', new_time, old_time)
+    if old_result != new_result:
+        sys.exit('ERROR: PostIndex results differ from full scans')
+
+
+# Blog pipeline ===============================================================
+
+def git_commit():
+    try:
+        commit = check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=blog.abs_root, stderr=DEVNULL, text=True).strip()
+        dirty = check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=blog.abs_root, stderr=DEVNULL, text=True).strip()
+    except (OSError, CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+def read_posts(site):
+    # Like load_posts, but without writing the post info back
+    for path in sorted(blog.posts_path.glob('*/*.rst')):
+        site.add_post(path, *blog.extract_post_info(path, path.read_text()))
+    return site
+
+
+def insert_post_info(site):
+    for post in site.posts:
+        blog.insert_into_file(post.path, 'post-info', post.post_info(for_post=True))
+
+
+def bench_pipeline(args):
+    results = {}
+    baseline = {}
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text())['results']
+    cwd = Path.cwd()
+    output = args.output.resolve()
+    cache_path = Path('_build/post-cache.json')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        template = tmp / 'template'
+        paths = generate_corpus(template, posts=args.posts, years=args.years, tags=args.tags,
+            tags_per_post=args.tags_per_post, paragraphs=args.paragraphs)
+        shutil.copyfile(blog.abs_root / blog.index_path, template / blog.index_path)
+        size = sum(path.stat().st_size for path in paths)
+        print(f'{len(paths)} posts, {size / len(paths) / 1024:.1f} KiB average, '
+            f'{args.tags} tags, {args.years} years')
+        site_path = tmp / 'site'
+
+        def new_site():
+            os.chdir(tmp)
+            if site_path.exists():
+                shutil.rmtree(site_path)
+            shutil.copytree(template, site_path)
+            os.chdir(site_path)
+
+        def run(name, func, setup=None, warm=False):
+            # Cold runs start from a new copy of the site each time. Warm runs
+            # go again on the site the run before left behind. The logs and
+            # verbose output of blog.py are kept out of the results.
+            best = None
+            func_args = ()
+            for i in range(args.repeat):
+                with redirect_stdout(io.StringIO()):
+                    if not warm:
+                        new_site()
+                    if setup is not None and (not warm or i == 0):
+                        func_args = (setup(),)
+                    start = time.perf_counter()
+                    func(*func_args)
+                    elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = best
+            report(name, best, baseline.get(name))
+
+        def load_posts():
+            return blog.load_posts(cache_path=cache_path, jobs=args.jobs)
+
+        def generate_blog():
+            return blog.generate_blog(False, cache_path=cache_path, jobs=args.jobs)
+
+        try:
+            for kind in ('cold', 'warm'):
+                run(f'load_posts {kind}', load_posts, warm=kind == 'warm')
+            for kind in ('cold', 'warm'):
+                run(f'generate_blog {kind}', generate_blog, warm=kind == 'warm')
+            for kind in ('cold', 'warm'):
+                run(f'insert_into_file {kind}', insert_post_info,
+                    setup=lambda: read_posts(blog.Blog()), warm=kind == 'warm')
+            for kind in ('cold', 'warm'):
+                run(f'write_blog_pages {kind}', blog.write_blog_pages,
+                    setup=load_posts, warm=kind == 'warm')
+            # PostIndex is made again each time for cold
+            run('PostIndex cold', index_queries, setup=load_posts, warm=True)
+            run('PostIndex warm', list_queries, setup=load_posts, warm=True)
+        finally:
+            os.chdir(cwd)
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({
+        'commit': git_commit(),
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'docutils': docutils.__version__,
+        'settings': {name: getattr(args, name) for name in
+            ('posts', 'years', 'tags', 'tags_per_post', 'paragraphs', 'jobs', 'repeat')},
+        'results': results,
+    }, indent=2) + '\n')
+    print(f'Wrote {output}')
+
+
+def bench_compare(args):
+    old = json.loads(args.old.read_text())
+    new = json.loads(args.new.read_text())
+    print(f'{old["commit"]} -> {new["commit"]}')
+    if old['settings'] != new['settings']:
+        print('WARNING: results are from different settings')
+    for name, elapsed in new['results'].items():
+        report(name, elapsed, old['results'].get(name))
+
+
+# Dev server load test =======================================================
+
+def load_client(host, port, paths, count, conditional, results):
+    conn = http.client.HTTPConnection(host, port)
+    etags = {}
+    statuses = Counter()
+    latencies = []
+    for i in range(count):
+        path = paths[i % len(paths)]
+        headers = {'Accept-Encoding': 'gzip, br'}
+        if conditional and path in etags:
+            headers['If-None-Match'] = etags[path]
+        start = time.perf_counter()
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        statuses[response.status] += 1
+        if response.getheader('ETag'):
+            etags[path] = response.getheader('ETag')
+        if response.will_close:
+            conn.close()
+            conn = http.client.HTTPConnection(host, port)
+    conn.close()
+    results.append((statuses, latencies))
+
+
+def bench_load(args):
+    httpd = None
+    if args.url is None:
+        html_output = args.dir.resolve()
+        if not html_output.is_dir():
+            sys.exit(f'ERROR: {html_output} has to be built first')
+        compressed = html_output.parent / 'compressed'
+        httpd = blog.make_server(html_output, '127.0.0.1', 0,
+            compressed=compressed if compressed.is_dir() else None)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        host, port = httpd.server_address[:2]
+        paths = ['/' + str(path.relative_to(html_output))
+            for path in sorted(html_output.glob('**/*')) if path.is_file()]
+    else:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+        paths = [url.path or '/']
+
+    results = []
+    clients = [threading.Thread(target=load_client,
+            args=(host, port, paths, args.requests // args.clients, args.conditional, results))
+        for i in range(args.clients)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+    if httpd is not None:
+        httpd.shutdown()
+
+    statuses = sum((r[0] for r in results), Counter())
+    latencies = sorted(latency for r in results for latency in r[1])
+    total = len(latencies)
+    print(f'{total} requests over {len(paths)} path(s) with {args.clients} client(s)')
+    print(f'{total / elapsed:.0f} requests/s')
+    print(f'latency p50 {latencies[total // 2] * 1000:.2f} ms, '
+        f'p99 {latencies[int(total * 0.99)] * 1000:.2f} ms')
+    print('status', ', '.join(f'{status}: {count}' for status, count in sorted(statuses.items())))
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--repeat',
+        metavar='N', type=int, default=3,
+        help='Take the best of N runs. Default is %(default)s'
+    )
+    subcmds = arg_parser.add_subparsers(required=True, dest='subcmd')
+
+    extract_subcmd = subcmds.add_parser('extract',
+        help='Compare post metadata extraction against the old asdom method')
+    extract_subcmd.add_argument('--posts', metavar='N', type=int, default=200)
+    extract_subcmd.add_argument('--paragraphs', metavar='N', type=int, default=200)
+    extract_subcmd.set_defaults(func=bench_extract)
+
+    index_subcmd = subcmds.add_parser('index',
+        help='Compare the year and tag post lists against sorting all posts for each')
+    index_subcmd.add_argument('--posts', metavar='N', type=int, default=50000)
+    index_subcmd.add_argument('--years', metavar='N', type=int, default=20)
+    index_subcmd.add_argument('--tags', metavar='N', type=int, default=500)
+    index_subcmd.set_defaults(func=bench_index)
+
+    pipeline_subcmd = subcmds.add_parser('pipeline',
+        help='Time the blog generation steps cold and warm on a synthetic site')
+    pipeline_subcmd.add_argument('--posts', metavar='N', type=int, default=1000)
+    pipeline_subcmd.add_argument('--years', metavar='N', type=int, default=10)
+    pipeline_subcmd.add_argument('--tags', metavar='N', type=int, default=100)
+    pipeline_subcmd.add_argument('--tags-per-post', metavar='N', type=int, default=3)
+    pipeline_subcmd.add_argument('--paragraphs', metavar='N', type=int, default=40)
+    pipeline_subcmd.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+        help='Number of processes to use for parsing posts. Default is %(default)s')
+    pipeline_subcmd.add_argument('--output',
+        metavar='PATH', type=Path,
+        help='Where to write the results as JSON. Default is '
+            f'{blog.default_build_path}/bench/pipeline-COMMIT.json')
+    pipeline_subcmd.add_argument('--baseline',
+        metavar='PATH', type=Path,
+        help='Results from an earlier run to show the speedup against')
+    pipeline_subcmd.set_defaults(func=bench_pipeline)
+
+    compare_subcmd = subcmds.add_parser('compare',
+        help='Compare the results of two pipeline runs')
+    compare_subcmd.add_argument('old', metavar='OLD', type=Path)
+    compare_subcmd.add_argument('new', metavar='NEW', type=Path)
+    compare_subcmd.set_defaults(func=bench_compare)
+
+    load_subcmd = subcmds.add_parser('load',
+        help='Measure requests/s of the dev server used by do serve')
+    load_subcmd.add_argument('--dir',
+        metavar='PATH', type=Path, default=blog.default_build_path / 'html',
+        help='Built site to serve. Default is %(default)s')
+    load_subcmd.add_argument('--url',
+        help='Load an already running server at this URL instead')
+    load_subcmd.add_argument('--clients', metavar='N', type=int, default=8)
+    load_subcmd.add_argument('--requests', metavar='N', type=int, default=4000)
+    load_subcmd.add_argument('--conditional',
+        action='store_true',
+        help='Send If-None-Match with the ETags from previous responses')
+    load_subcmd.set_defaults(func=bench_load)
+
+    args = arg_parser.parse_args()
+    if args.func is bench_pipeline and args.output is None:
+        commit = git_commit() or 'unknown'
+        args.output = blog.default_build_path / 'bench' / \
+            f'pipeline-{commit[:12]}{"-dirty" if commit.endswith("-dirty") else ""}.json'
+    args.func(args)
+
+# vim: expandtab:ts=4:sw=4
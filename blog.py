@@ -8,21 +8,33 @@ import sys
 import os
 import venv
 import webbrowser
-from subprocess import check_call
+from subprocess import check_call, check_output, CalledProcessError, Popen, PIPE
 from shutil import rmtree
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from pathlib import Path
+import http
 import http.server
-import socketserver
+import email.utils
+import threading
+import stat
 from datetime import datetime, timezone
 from textwrap import dedent
 import time
 import mimetypes
-
-import docutils.nodes
-import docutils.parsers.rst
-import docutils.utils
-import docutils.frontend
+import re
+import gzip
+import hashlib
+import json
+import copy
+import platform
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import Counter
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # Imported where they're used, so commands that don't parse are faster
+    import docutils.nodes
 
 
 root = Path(__file__).parent
@@ -30,6 +42,8 @@ abs_root = root.resolve()
 reqs_path = abs_root / 'requirements.txt'
 default_venv_path = root / '.venv'
 default_build_path = root / '_build'
+# Wheels of the requirements, so the venv can be made again offline
+wheel_cache_path = abs_root / '.wheels'
 
 
 # For icons
@@ -41,12 +55,57 @@ def hex_to_rgb(s):
 name = 'iguessthislldo'
 url = 'fred.hornsey.us'
 aws = 's3-website-us-east-1.amazonaws.com'
+s3_upload_jobs = 16
+# Set to skip looking up the CloudFront distribution for the site
+cf_distribution_id = None
+deploy_cache_path = abs_root / '.deploy-cache.json'
+# Changed files in a directory past this are invalidated using a wildcard
+cf_wildcard_threshold = 10
+# Limits on paths in one CloudFront invalidation
+cf_max_paths = 1000
+cf_max_wildcards = 15
 black = (0, 0, 0)
 transparent = 0
 theme_fg_hex = '#00ff00'
 theme_bg_hex = '#282828'
 theme_fg = hex_to_rgb(theme_fg_hex)
 theme_bg = hex_to_rgb(theme_bg_hex)
+font_path = abs_root / 'monofur.ttf'
+logo_font_size = 46
+logo_margin = (10, 10)
+icon_text = '%'
+icon_font_size = 400
+icon_margin = (50, 20)
+# Icons made from the same image: name -> (size, save arguments)
+icon_files = {
+    'favicon.ico': (48, {'bitmap_format': 'bmp'}),
+    'favicon-32x32.png': (32, {}),
+    'favicon-16x16.png': (16, {}),
+    'android-chrome-512x512.png': (512, {}),
+    'android-chrome-192x192.png': (192, {}),
+    'mstile-150x150.png': (150, {}),
+    'apple-touch-icon.png': (180, {}),
+}
+# Bump if the way icons are made changes
+icons_version = 1
+# Widths of the copies made of images in posts
+image_widths = (480, 960, 1440)
+# How wide images are shown, so browsers can pick a width from the srcset
+image_sizes = '(max-width: 46em) 100vw, 46em'
+# Formats to make copies in, if Pillow supports them, in order of preference
+image_formats = {
+    '.avif': ('AVIF', {'quality': 60}),
+    '.webp': ('WEBP', {'quality': 80, 'method': 6}),
+}
+# Formats of images that copies can be made of, which copies are also made in
+# for browsers that don't support the others.
+image_fallback_formats = {
+    '.png': ('PNG', {'optimize': True}),
+    '.jpg': ('JPEG', {'quality': 85, 'optimize': True, 'progressive': True}),
+    '.jpeg': ('JPEG', {'quality': 85, 'optimize': True, 'progressive': True}),
+}
+# Bump if the way image copies are made changes
+images_version = 2
 templates_path = abs_root / '_templates'
 direct_copy_path = abs_root / 'root'
 static_path = abs_root / '_static'
@@ -56,7 +115,33 @@ static_path = abs_root / '_static'
 posts_path = Path('posts')
 index_path = Path('index.rst')
 tags_path = Path('tags')
+watch_paths = [
+    posts_path,
+    index_path,
+    Path('about.rst'),
+    templates_path,
+    static_path,
+    abs_root / 'conf.py',
+]
 now = datetime.now(timezone.utc)
+# Bump if what's stored in the post cache changes
+post_cache_version = 1
+
+# For checking links
+# How long to trust a result in seconds. Failed links are checked again
+# sooner, but less often each time they fail again.
+linkcheck_ok_ttl = 7 * 24 * 60 * 60
+linkcheck_failed_ttl = 6 * 60 * 60
+linkcheck_workers = 8
+# Seconds between requests to the same host
+linkcheck_host_interval = 1.0
+linkcheck_timeout = 15
+# Bump if how links are found or checked changes
+linkcheck_cache_version = 2
+linkcheck_user_agent = f'Mozilla/5.0 (compatible; {name} linkcheck; +https://{url})'
+
+
+log_lock = threading.Lock()
 
 
 def log(*args, **kwargs):
@@ -65,8 +150,10 @@ def log(*args, **kwargs):
     prefix = 'build.py: '
     if error:
         prefix += 'ERROR: '
-    print(prefix, end='', file=f)
-    print(*args, **kwargs, file=f, flush=True)
+    # Keep lines from threads from getting mixed together
+    with log_lock:
+        print(prefix, end='', file=f)
+        print(*args, **kwargs, file=f, flush=True)
 
 
 def slugify(*args, **kw):
@@ -74,17 +161,544 @@ def slugify(*args, **kw):
     return _slugify(*args, replacements=[["'", ''], ['"', '']], **kw)
 
 
+def write_if_changed(path, text, changes=None):
+    # Leave the file alone if nothing changed, so the mtime doesn't make Sphinx
+    # think it's out of date. Returns if the file was written and counts
+    # what happened in changes if passed.
+    data = text.encode('utf-8')
+    try:
+        change = 'unchanged' if path.read_bytes() == data else 'updated'
+    except FileNotFoundError:
+        change = 'added'
+    if change != 'unchanged':
+        path.write_bytes(data)
+    if changes is not None:
+        changes[change] += 1
+    if change != 'unchanged':
+        build_report.count_file('written', path)
+    return change != 'unchanged'
+
+
+def max_rss_kib(children=False):
+    import resource
+
+    rss = resource.getrusage(
+        resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def children_cpu_time():
+    # Only includes child processes that have finished
+    import resource
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class BuildReport:
+    '''\
+    Where the time in a build goes. Phases are timed with phase() and can be
+    nested. Actions that run at the same time each have their own phases, but
+    CPU times are for the whole process. DocEnv writes this to
+    _build/report.json.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.actions = {}
+        self.parse_times = {}
+        self.files = Counter()
+        # Files written or removed, so watch can tell them from the user's
+        # changes
+        self.changed_paths = set()
+
+    def count_file(self, kind, path=None):
+        with self.lock:
+            self.files[kind] += 1
+            if path is not None:
+                self.changed_paths.add(path)
+
+    @contextmanager
+    def phase(self, name):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        stack = self.local.stack
+        stack.append(name)
+        with self.lock:
+            phase = self.phases.setdefault('/'.join(stack),
+                {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'children_cpu': 0.0})
+        start = time.perf_counter()
+        start_cpu = time.process_time()
+        start_children_cpu = children_cpu_time()
+        try:
+            yield
+        finally:
+            phase['count'] += 1
+            phase['wall'] += time.perf_counter() - start
+            phase['cpu'] += time.process_time() - start_cpu
+            phase['children_cpu'] += children_cpu_time() - start_children_cpu
+            stack.pop()
+
+    def to_json(self):
+        with self.lock:
+            phases = list(self.phases.items())
+        return {
+            'created': datetime.now(timezone.utc).isoformat(),
+            'argv': sys.argv[1:],
+            'wall': round(time.perf_counter() - self.start, 6),
+            'actions': self.actions,
+            'phases': [dict(name=name, **{k: round(v, 6) for k, v in phase.items()})
+                for name, phase in phases],
+            'posts_parsed': {path: round(elapsed, 6) for path, elapsed in
+                sorted(self.parse_times.items(), key=lambda i: i[1], reverse=True)},
+            'files': dict(self.files),
+            'peak_rss_kib': max_rss_kib(),
+            'children_peak_rss_kib': max_rss_kib(children=True),
+        }
+
+    def write(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.to_json(), indent=2) + '\n')
+
+
+build_report = BuildReport()
+
+
+# What's in the site, so it doesn't depend on the system's MIME types
+site_mimetypes = {
+    '.html': 'text/html',
+    '.css': 'text/css',
+    '.js': 'text/javascript',
+    '.json': 'application/json',
+    '.map': 'application/json',
+    '.txt': 'text/plain',
+    '.xml': 'application/xml',
+    '.webmanifest': 'application/manifest+json',
+    '.inv': 'application/octet-stream',
+    '.ico': 'image/x-icon',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.svg': 'image/svg+xml',
+    '.svgz': 'image/svg+xml',
+    '.webp': 'image/webp',
+    '.avif': 'image/avif',
+    '.woff': 'font/woff',
+    '.woff2': 'font/woff2',
+    '.ttf': 'font/ttf',
+    '.otf': 'font/otf',
+    '.eot': 'application/vnd.ms-fontobject',
+}
+site_encodings = {
+    '.svgz': 'gzip',
+}
+
+# Cache-Control headers for uploads
+immutable_cache_control = 'public, max-age=31536000, immutable'
+static_cache_control = 'public, max-age=604800'
+default_cache_control = 'public, max-age=86400'
+revalidate_cache_control = 'no-cache'
+# Files with a content hash in the name can be cached forever
+hashed_name_re = re.compile(r'[.-][0-9a-f]{8,}\.[^/]+$')
+static_dirs = ('_static/', '_sphinx_design_static/', '_images/')
+
+
+def sniff_mimetype(path, size=1024):
+    with path.open('rb') as f:
+        start = f.read(size)
+    if b'\0' in start:
+        return 'binary/octet-stream'
+    try:
+        start.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # Could just be a character cut off at the end
+        if e.start < len(start) - 3:
+            return 'binary/octet-stream'
+    return 'text/plain'
+
+
 def get_mimetype(path):
-    mimetype, _ = mimetypes.guess_type(path)
+    mimetype = site_mimetypes.get(path.suffix.lower())
     if mimetype is None:
-        try:
-            path.read_text()
-            mimetype = 'text/plain'
-        except UnicodeDecodeError:
-            mimetype = 'binary/octet-stream'
+        mimetype, _ = mimetypes.guess_type(path.name, strict=False)
+    if mimetype is None:
+        mimetype = sniff_mimetype(path)
     return mimetype
 
 
+def get_content_encoding(path):
+    return site_encodings.get(path.suffix.lower())
+
+
+def get_cache_control(key, mimetype):
+    # Pages always have to be checked for changes, even if their name happens
+    # to end in something that looks like a hash, like a date.
+    if mimetype == 'text/html':
+        return revalidate_cache_control
+    if hashed_name_re.search(key):
+        return immutable_cache_control
+    if key.startswith(static_dirs):
+        return static_cache_control
+    if mimetype.startswith(('image/', 'font/')):
+        return default_cache_control
+    # Pages and things like the search index have to be checked for changes
+    return revalidate_cache_control
+
+
+def md5_file(path):
+    md5 = hashlib.md5()
+    with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+# Types worth compressing. The rest are already compressed or too small.
+compressible_types = ('text/', 'application/json', 'application/xml',
+    'application/manifest+json', 'image/svg+xml')
+# Compressed variants have to be smaller than this fraction of the original
+min_compression_ratio = 0.9
+# Suffixes of compressed variants by encoding, in order of preference
+compressed_suffixes = {'br': '.br', 'gzip': '.gz'}
+
+
+def get_compressors():
+    compressors = {'gzip': lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+    try:
+        import brotli
+        compressors['br'] = lambda data: brotli.compress(data, quality=11)
+    except ImportError:
+        pass
+    return compressors
+
+
+def get_variant(compressed_path, key, encoding, mtime_ns):
+    # Returns the compressed variant of key if it's up to date with a file
+    # modified at mtime_ns and worth using. Empty variants mark files that
+    # didn't compress well enough, which nothing compresses to.
+    variant = compressed_path / (key + compressed_suffixes[encoding])
+    try:
+        st = variant.stat()
+    except FileNotFoundError:
+        return None
+    if st.st_mtime_ns >= mtime_ns and st.st_size > 0:
+        return variant
+    return None
+
+
+def compress_file(path, key, compressed_path, compressors):
+    # Returns the size of the file and of each variant that's worth keeping
+    st = path.stat()
+    data = None
+    sizes = {}
+    for encoding, compress in compressors.items():
+        dst = compressed_path / (key + compressed_suffixes[encoding])
+        try:
+            dst_st = dst.stat()
+            if dst_st.st_mtime_ns >= st.st_mtime_ns:
+                if dst_st.st_size > 0:
+                    sizes[encoding] = dst_st.st_size
+                continue
+        except FileNotFoundError:
+            pass
+        if data is None:
+            data = path.read_bytes()
+        compressed = compress(data)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        if len(compressed) > len(data) * min_compression_ratio:
+            # Left empty so it isn't compressed again until it changes
+            dst.write_bytes(b'')
+            continue
+        dst.write_bytes(compressed)
+        sizes[encoding] = len(compressed)
+    return st.st_size, sizes
+
+
+def compress_site(html_output, compressed_path, jobs=None):
+    '''\
+    Write gzip, and brotli if it's installed, variants of compressible files in
+    html_output to compressed_path. Only files that changed since their
+    variants were written are compressed again.
+    '''
+    compressors = get_compressors()
+    files = []
+    for path in sorted(html_output.glob('**/*')):
+        if path.is_file() and get_content_encoding(path) is None and \
+                get_mimetype(path).startswith(compressible_types):
+            files.append((path, str(path.relative_to(html_output))))
+
+    # Remove variants of files that aren't there anymore
+    keys = {key for path, key in files}
+    for path in compressed_path.glob('**/*'):
+        if path.is_file() and str(path.relative_to(compressed_path).with_suffix('')) not in keys:
+            path.unlink()
+
+    with ThreadPoolExecutor(jobs) as executor:
+        results = list(executor.map(
+            lambda item: compress_file(*item, compressed_path, compressors), files))
+    total = sum(size for size, sizes in results)
+    for encoding in compressors:
+        saved = sum(size - sizes.get(encoding, size) for size, sizes in results)
+        count = sum(encoding in sizes for size, sizes in results)
+        log(f'{encoding}: {count} of {len(files)} file(s) compressed, '
+            f'saving {saved} of {total} bytes ({saved / max(total, 1):.0%})')
+
+
+def accepted_encodings(header):
+    encodings = set()
+    for item in header.split(','):
+        name, _, params = item.partition(';')
+        params = params.replace(' ', '')
+        try:
+            if params.startswith('q=') and float(params[2:]) == 0:
+                continue
+        except ValueError:
+            pass
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+# What's compared to decide if a file needs to be uploaded again
+manifest_fields = ('size', 'hash', 'content_type', 'content_encoding', 'cache_control')
+
+
+def load_manifest(path):
+    # Returns None if there isn't a usable manifest
+    try:
+        return json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def build_manifest(html_output, previous={}, compressed_path=None):
+    '''\
+    Returns what's needed to deploy each file in html_output by key. Gzip
+    variants in compressed_path are used instead of the file if there is one.
+    Hashes are reused from the previous manifest if the size and mtime of what's
+    uploaded are the same.
+    '''
+    manifest = {}
+    for path in sorted(html_output.glob('**/*')):
+        if not path.is_file():
+            continue
+        key = str(path.relative_to(html_output))
+        upload_path = path
+        encoding = get_content_encoding(path)
+        if compressed_path is not None and encoding is None:
+            variant = get_variant(compressed_path, key, 'gzip', path.stat().st_mtime_ns)
+            if variant is not None:
+                upload_path = variant
+                encoding = 'gzip'
+        st = upload_path.stat()
+        entry = previous.get(key, {})
+        if entry.get('size') == st.st_size and entry.get('mtime_ns') == st.st_mtime_ns:
+            md5 = entry['hash']
+        else:
+            md5 = md5_file(upload_path)
+        mimetype = get_mimetype(path)
+        manifest[key] = {
+            'file': str(upload_path),
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'hash': md5,
+            'content_type': mimetype,
+            'content_encoding': encoding,
+            'cache_control': get_cache_control(key, mimetype),
+        }
+    return manifest
+
+
+def list_s3_objects(s3, bucket):
+    # Returns the bucket's contents like a manifest, but only with what S3 has:
+    # the size and the MD5 in the ETag.
+    objects = {}
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = {'size': obj['Size'], 'hash': obj['ETag'].strip('"')}
+    return objects
+
+
+def plan_sync(manifest, previous):
+    # Returns the keys to upload and delete to get from previous to manifest
+    to_upload = []
+    for key, entry in manifest.items():
+        old = previous.get(key)
+        if old is None or any(old[f] != entry[f] for f in manifest_fields if f in old):
+            to_upload.append(key)
+    to_delete = sorted(key for key in previous if key not in manifest)
+    return to_upload, to_delete
+
+
+def sync_to_s3(s3, bucket, manifest, to_upload, to_delete, jobs=s3_upload_jobs):
+    '''\
+    Upload the to_upload keys in the manifest using a bounded thread pool,
+    then delete the to_delete keys so the site is never missing anything.
+    '''
+    def upload(key):
+        entry = manifest[key]
+        extra = {'ContentType': entry['content_type']}
+        if entry['content_encoding'] is not None:
+            extra['ContentEncoding'] = entry['content_encoding']
+        if entry['cache_control'] is not None:
+            extra['CacheControl'] = entry['cache_control']
+        with open(entry['file'], 'rb') as f:
+            s3.put_object(Bucket=bucket, Key=key, Body=f, **extra)
+        log(f'Uploaded {bucket}/{key} as {entry["content_type"]}')
+
+    with ThreadPoolExecutor(jobs) as executor:
+        list(executor.map(upload, to_upload))
+
+    for i in range(0, len(to_delete), 1000):
+        batch = to_delete[i:i + 1000]
+        s3.delete_objects(Bucket=bucket, Delete={
+            'Objects': [{'Key': key} for key in batch],
+            'Quiet': True,
+        })
+        for key in batch:
+            log(f'Deleted {bucket}/{key}')
+
+
+def prune_stale_html(html_output):
+    # Sphinx leaves pages of removed sources, like tags that only had drafts
+    for path in html_output.glob('**/*.html'):
+        rel = path.relative_to(html_output)
+        if rel.parts[0].startswith('_') or str(rel) in ('search.html', 'genindex.html'):
+            continue
+        if not (abs_root / rel).with_suffix('.rst').is_file() and not (direct_copy_path / rel).is_file():
+            log('Removing stale', path)
+            path.unlink()
+
+
+def invalidation_parent(path):
+    # '/a/b.html', '/a/b/', and '/a/b/*' are all in '/a/'
+    return path.rstrip('*').rstrip('/').rsplit('/', 1)[0] + '/'
+
+
+def plan_invalidation(keys, threshold=cf_wildcard_threshold,
+        max_paths=cf_max_paths, max_wildcards=cf_max_wildcards):
+    '''\
+    Returns batches of CloudFront paths to invalidate for the changed and
+    removed S3 keys. Directories with more than threshold paths are replaced by
+    a wildcard, deepest first so those can be collapsed again in their parent.
+    Each batch has at most max_paths paths and max_wildcards wildcards.
+    '''
+    paths = set()
+    for key in keys:
+        paths.add('/' + key)
+        # Directories are also cached using their own URL
+        if key == 'index.html' or key.endswith('/index.html'):
+            paths.add('/' + key[:-len('index.html')])
+
+    while True:
+        dirs = {}
+        for path in paths:
+            dirs.setdefault(invalidation_parent(path), set()).add(path)
+        # A directory that's already just its wildcard can't be collapsed more
+        collapse = [d for d, dir_paths in dirs.items()
+            if len(dir_paths) > threshold and dir_paths != {d + '*'}]
+        if not collapse:
+            break
+        d = max(collapse, key=lambda d: d.count('/'))
+        paths = {path for path in paths if not path.startswith(d)}
+        paths.add(d + '*')
+
+    batches = []
+    batch_paths = max_paths
+    batch_wildcards = max_wildcards
+    for path in sorted(paths):
+        wildcard = path.endswith('*')
+        if batch_paths == max_paths or (wildcard and batch_wildcards == max_wildcards):
+            batches.append([])
+            batch_paths = 0
+            batch_wildcards = 0
+        batches[-1].append(path)
+        batch_paths += 1
+        batch_wildcards += wildcard
+    return batches
+
+
+def distribution_has_origin(cloudfront, distro_id, origin):
+    try:
+        distribution = cloudfront.get_distribution(Id=distro_id)['Distribution']
+    except cloudfront.exceptions.NoSuchDistribution:
+        return False
+    origins = distribution['DistributionConfig']['Origins'].get('Items', [])
+    return any(cf_origin['DomainName'] == origin for cf_origin in origins)
+
+
+def find_distribution(cloudfront, origin):
+    paginator = cloudfront.get_paginator('list_distributions')
+    for page in paginator.paginate():
+        for distribution in page['DistributionList'].get('Items', []):
+            for cf_origin in distribution['Origins']['Items']:
+                log('Origin found {}'.format(cf_origin['DomainName']))
+                if origin == cf_origin['DomainName']:
+                    return distribution['Id']
+    return None
+
+
+def get_distribution(cloudfront, origin, cache_path=deploy_cache_path):
+    # Finding the distribution means going through every distribution in the
+    # account, so remember it and just check it's still right next time.
+    cache = {}
+    if cache_path.is_file():
+        try:
+            cache = json.loads(cache_path.read_text())
+        except ValueError:
+            pass
+    distributions = cache.setdefault('distributions', {})
+    distro_id = distributions.get(origin)
+    if distro_id is not None:
+        if distribution_has_origin(cloudfront, distro_id, origin):
+            log(f'Using cached CF distribution ID {distro_id}')
+            return distro_id
+        log(f'Cached CF distribution {distro_id} no longer has {origin}')
+
+    distro_id = find_distribution(cloudfront, origin)
+    if distro_id is not None:
+        distributions[origin] = distro_id
+        write_if_changed(cache_path, json.dumps(cache, indent=4) + '\n')
+    return distro_id
+
+
+def invalidate_cloudfront(cloudfront, distro_id, batches, wait=False):
+    # CloudFront limits how many paths can be in progress, so wait for each
+    # batch to finish before submitting the next.
+    waiter = cloudfront.get_waiter('invalidation_completed')
+    for i, batch in enumerate(batches):
+        invalidation_id = cloudfront.create_invalidation(
+            DistributionId=distro_id,
+            InvalidationBatch={
+            'Paths': {
+                'Quantity': len(batch),
+                'Items': batch,
+            },
+            'CallerReference': f'{time.time()}-{i}',
+        })['Invalidation']['Id']
+        log(f'Submitted invalidation {invalidation_id} for {len(batch)} path(s)')
+        if wait or i + 1 < len(batches):
+            log(f'Waiting for invalidation {invalidation_id}...')
+            waiter.wait(DistributionId=distro_id, Id=invalidation_id,
+                WaiterConfig={'Delay': 5, 'MaxAttempts': 360})
+
+
+def text_bbox(text, font, align='center', stroke_width=0):
+    # Measuring doesn't depend on the size of the image, so use a tiny one
+    from PIL import Image, ImageDraw
+
+    draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+    box = draw.multiline_textbbox(
+        (0, 0), text, font=font, align=align, stroke_width=stroke_width)
+    return tuple(int(i) for i in box)
+
+
 def text_to_image(
         text: str,
         font_filepath: str,
@@ -98,14 +712,7 @@ def text_to_image(
     from PIL import Image, ImageFont, ImageDraw, ImageColor
 
     font = ImageFont.truetype(font_filepath, size=font_size)
-    tmp_img = Image.new('RGBA', (10000, 10000))
-    tmp_draw = ImageDraw.Draw(tmp_img)
-    box = tmp_draw.multiline_textbbox(
-        (0, 0), text, font=font, align=align, stroke_width=stroke_width)
-    left = int(box[0])
-    right = int(box[2])
-    top = int(box[1])
-    bottom = int(box[3])
+    left, top, right, bottom = text_bbox(text, font, align, stroke_width)
     mx = margin[0]
     my = margin[1]
     img = Image.new('RGBA', (right - left + mx * 2, bottom - top + my * 2), bg_color)
@@ -120,38 +727,76 @@ def text_to_image(
 
 
 def make(text, font_size, margin, fg_color=theme_fg, bg_color=theme_bg, **kw):
-    return text_to_image(text, str(abs_root / 'monofur.ttf'), font_size, fg_color, bg_color, margin, **kw)
+    return text_to_image(text, str(font_path), font_size, fg_color, bg_color, margin, **kw)
 
 
 def save(img, name, resize=None, dst=direct_copy_path, **kw):
+    from PIL import Image
+
     if resize is not None:
-        img = img.resize((resize, resize))
+        img = img.resize((resize, resize), resample=Image.Resampling.LANCZOS)
     img.save(str(dst / name), **kw)
 
 
-def generate_icons():
-    log('Generating icons...')
+def scale_icon(font_size, margin, size):
+    # Returns the font size and margin to render the icon at so its smallest
+    # side is at least size and every icon can be scaled down from it.
+    from PIL import ImageFont
 
-    # Logo
-    def make_logo(kind, fg_color):
-        save(make('%' + name, 46, (10, 10), fg_color=fg_color, bg_color=transparent),
-            f'logo-{kind}.png', dst=static_path)
+    scale = 1
+    while True:
+        font = ImageFont.truetype(str(font_path), size=round(font_size * scale))
+        left, top, right, bottom = text_bbox(icon_text, font)
+        scaled_margin = tuple(round(m * scale) for m in margin)
+        if min(right - left + scaled_margin[0] * 2, bottom - top + scaled_margin[1] * 2) >= size:
+            return round(font_size * scale), scaled_margin
+        scale *= 1.05
 
-    make_logo('light', fg_color=black)
-    make_logo('dark', fg_color=theme_fg)
 
-    # Icons
-    icon = make('%', 400, (50, 20))
-    save(icon, 'favicon.ico', resize=48, bitmap_format='bmp')
-    save(icon, 'favicon-32x32.png', resize=32)
-    save(icon, 'favicon-16x16.png', resize=16)
-    save(icon, 'android-chrome-512x512.png', resize=512)
-    save(icon, 'android-chrome-192x192.png', resize=192)
-    save(icon, 'mstile-150x150.png', resize=150)
-    save(icon, 'apple-touch-icon.png', resize=180)
+def icons_hash():
+    # Everything that goes into the icons
+    h = hashlib.sha256(font_path.read_bytes())
+    h.update(repr((
+        icons_version, name, black, transparent, theme_fg, theme_bg,
+        logo_font_size, logo_margin, icon_text, icon_font_size, icon_margin, icon_files,
+    )).encode('utf-8'))
+    return h.hexdigest()
+
+
+def generate_icons(stamp_path=None):
+    log('Generating icons...')
+
+    outputs = [static_path / f'logo-{kind}.png' for kind in ('light', 'dark')]
+    outputs += [direct_copy_path / icon for icon in icon_files]
+    digest = icons_hash()
+    if stamp_path is not None and stamp_path.is_file() and \
+            stamp_path.read_text() == digest and all(path.is_file() for path in outputs):
+        log('Icons are up to date')
+    else:
+        rss_before = max_rss_kib()
+
+        # Logo
+        def make_logo(kind, fg_color):
+            save(make('%' + name, logo_font_size, logo_margin, fg_color=fg_color, bg_color=transparent),
+                f'logo-{kind}.png', dst=static_path)
+
+        make_logo('light', fg_color=black)
+        make_logo('dark', fg_color=theme_fg)
+
+        # Icons
+        font_size, margin = scale_icon(icon_font_size, icon_margin,
+            max(size for size, kw in icon_files.values()))
+        icon = make(icon_text, font_size, margin)
+        for icon_name, (size, kw) in icon_files.items():
+            save(icon, icon_name, resize=size, **kw)
+
+        log(f'Peak RSS was {rss_before} KiB before and {max_rss_kib()} KiB after')
+        if stamp_path is not None:
+            stamp_path.parent.mkdir(parents=True, exist_ok=True)
+            stamp_path.write_text(digest)
 
     # Text Files
-    (direct_copy_path / 'browserconfig.xml').write_text(dedent('''\
+    write_if_changed(direct_copy_path / 'browserconfig.xml', dedent('''\
         <?xml version="1.0" encoding="utf-8"?>
         <browserconfig>
             <msapplication>
@@ -162,7 +807,7 @@ def generate_icons():
             </msapplication>
         </browserconfig>
         '''))
-    (direct_copy_path / 'site.webmanifest').write_text(dedent('''\
+    write_if_changed(direct_copy_path / 'site.webmanifest', dedent('''\
         {
             "name": "''' + name + '''",
             "short_name": "''' + name + '''",
@@ -185,80 +830,343 @@ def generate_icons():
         '''))
 
 
-def parse_rst(path: Path) -> docutils.nodes.document:
+image_ref_re = re.compile(r'^\s*\.\. (?:\|[^|]+\| )?(?:image|figure)::\s*(\S.*?)\s*$', re.M)
+img_tag_re = re.compile(r'<img\b[^>]*>')
+img_src_re = re.compile(r'\bsrc="([^"]+)"')
+# Names of the copies in the built site's _images
+image_copy_re = re.compile(r'-[0-9]+w-[0-9a-f]{12}\.[a-z]+$')
+image_used_re = re.compile(r'_images/([^"\s,]+-[0-9]+w-[0-9a-f]{12}\.[a-z]+)')
+
+
+def find_post_images(paths):
+    # Returns the images that the posts at paths use with the image and figure
+    # directives that copies can be made of.
+    images = set()
+    for path in paths:
+        for match in image_ref_re.finditer(path.read_text()):
+            uri = match.group(1)
+            if '://' in uri or uri.startswith('data:'):
+                continue
+            # Like Sphinx, absolute paths are relative to the source directory
+            image = Path(os.path.normpath(uri[1:] if uri.startswith('/') else path.parent / uri))
+            if image.suffix.lower() in image_fallback_formats and image.is_file():
+                images.add(image)
+    return sorted(images)
+
+
+def get_image_formats(suffix):
+    from PIL import features
+
+    formats = {s: f for s, f in image_formats.items() if features.check(f[0].lower())}
+    formats[suffix] = image_fallback_formats[suffix]
+    return formats
+
+
+def image_key(data, formats):
+    # Names copies by the contents of the image and everything that goes into
+    # making them.
+    h = hashlib.sha256(repr((images_version, image_widths, formats)).encode('utf-8'))
+    h.update(data)
+    return h.hexdigest()[:16]
+
+
+def make_image_copies(path, cache_path):
+    '''\
+    Write copies of the image at path at each of image_widths that's smaller
+    than it, and at its own width, in each format to cache_path/<key>/. Returns
+    the key and info about the copies, which are only made if they aren't
+    already there.
+    '''
+    from PIL import Image, ImageOps
+
+    data = path.read_bytes()
+    formats = get_image_formats(path.suffix.lower())
+    key = image_key(data, formats)
+    dst = cache_path / key
+    info_path = dst / 'info.json'
+    if info_path.is_file():
+        return key, json.loads(info_path.read_text()), False
+
+    with Image.open(path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if img.has_transparency_data else 'RGB')
+    widths = sorted({width for width in image_widths if width < img.width} | {img.width})
+    info = {'width': img.width, 'height': img.height, 'copies': []}
+    if dst.is_dir():
+        rmtree(dst)
+    dst.mkdir(parents=True)
+    for width in widths:
+        resized = img
+        if width != img.width:
+            resized = img.resize((width, max(1, round(img.height * width / img.width))),
+                resample=Image.Resampling.LANCZOS)
+        for suffix, (fmt, kw) in formats.items():
+            name = f'{width}{suffix}'
+            resized.save(dst / name, fmt, **kw)
+            info['copies'].append([suffix, width, name])
+    # Written last so a partly written directory isn't used
+    info_path.write_text(json.dumps(info))
+    return key, info, True
+
+
+def make_post_images(cache_path, jobs=None):
+    '''\
+    Make copies of the images used in posts in cache_path. Returns the key and
+    info of each image, by key. Images are only processed again if they or the
+    settings changed.
+    '''
+    # Images with the same contents share a key, so each key is made once
+    # instead of by threads racing on the same directory.
+    images = {}
+    for path in find_post_images(sorted(posts_path.glob('*/*.rst'))):
+        key = image_key(path.read_bytes(), get_image_formats(path.suffix.lower()))
+        images.setdefault(key, path)
+    with ThreadPoolExecutor(jobs) as executor:
+        results = list(executor.map(lambda path: make_image_copies(path, cache_path),
+            images.values()))
+    made = sum(new for key, info, new in results)
+    log(f'Images: {len(results)} image(s), {made} made, {len(results) - made} cached')
+
+    # Remove copies of images that aren't used anymore
+    keys = {key: info for key, info, new in results}
+    if cache_path.is_dir():
+        for path in cache_path.iterdir():
+            if path.name not in keys:
+                rmtree(path)
+    return keys
+
+
+def add_image_srcsets(html_output, cache_path, images):
+    '''\
+    Copy the copies of images into the built site and give the img elements
+    that show them srcset and sizes attributes, and picture elements with a
+    source for each of the other formats.
+    '''
+    images_output = html_output / '_images'
+    keys = {}
+    copied = set()
+
+    def get_key(path):
+        # Sphinx can rename images, so they're found by their contents
+        if path not in keys:
+            keys[path] = None
+            if path.parent == images_output and path.suffix.lower() in image_fallback_formats \
+                    and path.is_file():
+                key = image_key(path.read_bytes(), get_image_formats(path.suffix.lower()))
+                if key in images:
+                    keys[path] = key
+        return keys[path]
+
+    def copy(path, key, suffix, width, name):
+        dst_name = f'{path.stem}-{width}w-{key[:12]}{suffix}'
+        dst = images_output / dst_name
+        if dst_name not in copied and not dst.is_file():
+            dst.write_bytes((cache_path / key / name).read_bytes())
+        copied.add(dst_name)
+        return dst_name
+
+    def add_srcset(html_path, match):
+        tag = match.group(0)
+        src = img_src_re.search(tag)
+        if 'srcset=' in tag or src is None or '://' in src.group(1):
+            return tag
+        path = Path(os.path.normpath(html_path.parent / src.group(1)))
+        key = get_key(path)
+        if key is None:
+            return tag
+        base = src.group(1)[:-len(path.name)]
+        srcsets = {}
+        for suffix, width, name in images[key]['copies']:
+            srcsets.setdefault(suffix, []).append(
+                f'{base}{copy(path, key, suffix, width, name)} {width}w')
+        sources = []
+        for suffix, srcset in srcsets.items():
+            srcset = ', '.join(srcset)
+            if suffix == path.suffix.lower():
+                end = -2 if tag.endswith('/>') else -1
+                tag = f'{tag[:end].rstrip()} srcset="{srcset}" sizes="{image_sizes}" {tag[end:]}'
+            else:
+                sources.append(f'<source type="{site_mimetypes[suffix]}" '
+                    f'srcset="{srcset}" sizes="{image_sizes}" />')
+        return '<picture>' + ''.join(sources) + tag + '</picture>'
+
+    changes = Counter()
+    used = set()
+    for path in sorted(posts_path.glob('*/*.rst')):
+        html_path = html_output / path.with_suffix('.html')
+        if html_path.is_file():
+            text = html_path.read_text()
+            new_text = img_tag_re.sub(lambda match: add_srcset(html_path, match), text)
+            if new_text != text:
+                write_if_changed(html_path, new_text, changes)
+            # Includes copies used by pages that Sphinx didn't write again
+            used |= set(image_used_re.findall(new_text))
+
+    # Remove copies that aren't used anymore
+    if images_output.is_dir():
+        for path in images_output.iterdir():
+            if image_copy_re.search(path.name) and path.name not in used:
+                path.unlink()
+    if changes:
+        log(f'Added srcsets to {changes["updated"]} page(s)')
+
+
+rst_settings = None
+
+
+def get_rst_settings():
+    # Making these takes longer than parsing a post header, so it's only done
+    # once and each document gets a copy.
+    import docutils.frontend
+    import docutils.parsers.rst
+    import docutils.utils
+
+    global rst_settings
+    if rst_settings is None:
+        rst_settings = docutils.frontend.get_default_settings(docutils.parsers.rst.Parser)
+        rst_settings.report_level = docutils.utils.Reporter.SEVERE_LEVEL
+    return copy.copy(rst_settings)
+
+
+def parse_rst(path: Path, text=None) -> 'docutils.nodes.document':
+    import docutils.parsers.rst
+    import docutils.utils
+
     parser = docutils.parsers.rst.Parser()
-    settings = docutils.frontend.get_default_settings(docutils.parsers.rst.Parser)
-    settings.report_level = docutils.utils.Reporter.SEVERE_LEVEL
-    document = docutils.utils.new_document(path.name, settings=settings)
-    parser.parse(path.read_text(), document)
+    document = docutils.utils.new_document(path.name, settings=get_rst_settings())
+    parser.parse(path.read_text() if text is None else text, document)
     return document
 
 
-def get_text(arg):
-    rc = []
-    for node in arg:
-        if node.nodeType == node.TEXT_NODE:
-            rc.append(node.data)
-        else:
-            rc.append(get_text(node.childNodes))
-    return ''.join(rc)
+def node_text(node):
+    import docutils.nodes
+
+    return ''.join(str(text) for text in node.findall(docutils.nodes.Text))
+
+
+def post_header(text):
+    # Metadata fields and the title come before the post info, so the body
+    # doesn't need to be parsed.
+    end = text.find('\n.. post-info-start\n')
+    return text if end == -1 else text[:end + 1]
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def extract_post_info(path, text):
+    import docutils.nodes
+
+    rst_doc = parse_rst(path, post_header(text))
+
+    # Get title
+    title_node = rst_doc.next_node(docutils.nodes.title)
+    title = None if title_node is None else node_text(title_node)
+
+    # Get doc_info (metadata)
+    doc_info = {}
+    for field_list in rst_doc.findall(docutils.nodes.field_list):
+        for field in field_list.children:
+            doc_info[node_text(field[0])] = node_text(field[1])
+
+    return title, doc_info
+
+
+class PostCache:
+    # Title and doc_info of posts from previous runs keyed by path and content
+    # hash, so unchanged posts don't have to be parsed again.
+
+    def __init__(self, path=None):
+        import docutils
+
+        self.path = path
+        self.key = f'{post_cache_version}-docutils-{docutils.__version__}'
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        if path is not None and path.is_file():
+            try:
+                data = json.loads(path.read_text())
+            except ValueError:
+                data = {}
+            if data.get('key') == self.key:
+                self.entries = data['posts']
+        self.new_entries = {}
+
+    def get(self, path, digest):
+        entry = self.entries.get(str(path))
+        if entry is not None and entry['hash'] == digest:
+            self.hits += 1
+            return entry['title'], entry['doc_info']
+        self.misses += 1
+        return None
+
+    def set(self, path, digest, title, doc_info):
+        self.new_entries[str(path)] = {
+            'hash': digest,
+            'title': title,
+            'doc_info': doc_info,
+        }
+
+    def save(self):
+        # Only posts seen this run are kept
+        if self.path is None or self.new_entries == self.entries:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        tmp_path.write_text(json.dumps({'key': self.key, 'posts': self.new_entries}))
+        tmp_path.replace(self.path)
 
 
 class Tag:
-    all_tags = {}
+    __slots__ = ('slug', 'name', 'posts')
 
     def __init__(self, slug, name):
         self.slug = slug
         self.name = name.strip()
-        self.ref_name = 'tag-' + self.slug
-        self.ref = f':bdg-ref-primary-line:`{self.name} <{self.ref_name}>`'
-        self.nonref = f':bdg-primary-line:`{self.name}`'
         self.posts = []
-        self.all_tags[self.slug] = self
 
     def __repr__(self):
         return f'<Tag: {self.name}>'
 
+    @property
+    def ref_name(self):
+        return 'tag-' + self.slug
+
+    @property
+    def ref(self):
+        return f':bdg-ref-primary-line:`{self.name} <{self.ref_name}>`'
+
+    @property
+    def nonref(self):
+        return f':bdg-primary-line:`{self.name}`'
+
     def get_ref(self, draft):
         # Unknown refs can cause annoying warnings if left over
         return self.nonref if draft else self.ref
 
-    @classmethod
-    def get_or_create(cls, name):
-        name = name.strip()
-        slug = slugify(name)
-        if slug in cls.all_tags:
-            tag = cls.all_tags[slug]
-        else:
-            tag = Tag(slug, name)
-        return tag
-
-    @classmethod
-    def process_tag_str(cls, post, tag_str):
-        tags = []
-        tag_str = tag_str.strip()
-        if tag_str:
-            for name in tag_str.split(','):
-                tag = Tag.get_or_create(name)
-                if tag not in tags:
-                    tag.posts.append(post)
-                    tags.append(tag)
-        return tags
 
-    @classmethod
-    def get_sorted(cls, tags=None):
-        return sorted(cls.all_tags.values() if tags is None else tags,
-            key=lambda t: (-len(t.posts), t.name))
+class PostIndex:
+    # Posts sorted once by date and title, then split up by year and tag in
+    # that order, so queries don't have to sort anything.
+    def __init__(self, posts):
+        self.posts = sorted(posts, key=lambda p: (p.dt(), p.title))
+        self.by_year = {}
+        self.by_tag = {}
+        for post in self.posts:
+            self.by_year.setdefault(post.dt().year, []).append(post)
+            for tag in post.tags:
+                self.by_tag.setdefault(tag.slug, []).append(post)
 
 
 class Post:
-    all_posts = []
+    __slots__ = ('path', 'title', 'draft', 'summary', 'created', 'published', 'tags')
 
-    def __init__(self, path, title, doc_info, include_drafts=True):
+    def __init__(self, path, title, doc_info):
         self.path = path
         self.title = title
-        self.link = str(path.with_suffix(''))
-        self.ref = f':doc:`/{self.link}`'
         self.draft = 'orphan' in doc_info
         self.summary = doc_info.get('summary')
         self.created = doc_info.get('created')
@@ -269,13 +1177,16 @@ class Post:
             self.published = datetime.fromisoformat(self.published)
         self.tags = []
 
-        if self.draft and not include_drafts:
-            return
+    def __repr__(self):
+        return f'<Post: {self.path}>'
 
-        if 'tags' in doc_info:
-            self.tags = Tag.process_tag_str(self, doc_info['tags'])
+    @property
+    def link(self):
+        return str(self.path.with_suffix(''))
 
-        self.all_posts.append(self)
+    @property
+    def ref(self):
+        return f':doc:`/{self.link}`'
 
     def tag_list(self, add_to):
         if self.tags:
@@ -312,29 +1223,78 @@ class Post:
         info.append('')
         return info
 
-    @classmethod
-    def get_years(cls, posts=None, year=None, reverse=True):
-        years = set()
-        for post in cls.all_posts:
-            years |= {post.dt().year}
-        return years
 
-    @classmethod
-    def get_sorted(cls, posts=None, year=None, reverse=True):
-        posts = Post.all_posts if posts is None else posts
+class Blog:
+    # The posts and tags of a site. Nothing is kept between instances, so a
+    # long running process can load a site as many times as it wants.
+    def __init__(self):
+        self.posts = []
+        self.tags = {}
+        self.index = None
+
+    def get_or_create_tag(self, name):
+        name = name.strip()
+        slug = slugify(name)
+        if slug in self.tags:
+            tag = self.tags[slug]
+        else:
+            tag = Tag(slug, name)
+            self.tags[slug] = tag
+        return tag
+
+    def process_tag_str(self, post, tag_str):
+        tags = []
+        tag_str = tag_str.strip()
+        if tag_str:
+            for name in tag_str.split(','):
+                tag = self.get_or_create_tag(name)
+                if tag not in tags:
+                    tag.posts.append(post)
+                    tags.append(tag)
+        return tags
+
+    def add_post(self, path, title, doc_info, include_drafts=True):
+        post = Post(path, title, doc_info)
+        if post.draft and not include_drafts:
+            return post
+
+        if 'tags' in doc_info:
+            post.tags = self.process_tag_str(post, doc_info['tags'])
+
+        self.posts.append(post)
+        self.index = None
+        return post
+
+    def get_index(self):
+        if self.index is None:
+            self.index = PostIndex(self.posts)
+        return self.index
+
+    def get_years(self):
+        return set(self.get_index().by_year)
+
+    def get_sorted(self, year=None, tag=None, reverse=True):
+        index = self.get_index()
         if year is not None:
-            posts = filter(lambda p: p.dt().year == year, posts)
-        posts = sorted(posts, key=lambda p: p.title)
-        return sorted(posts, key=lambda p: p.dt(), reverse=reverse)
+            posts = index.by_year.get(year, [])
+        elif tag is not None:
+            posts = index.by_tag.get(tag.slug, [])
+        else:
+            posts = index.posts
+        return posts[::-1] if reverse else list(posts)
 
+    def get_sorted_tags(self):
+        return sorted(self.tags.values(), key=lambda t: (-len(t.posts), t.name))
 
-def insert_into_file(path, marker, lines):
+
+def insert_into_file(path, marker, lines, changes=None):
     rewrite_lines = True
     found_start = False
     found_end = False
     rewrite = []
     start_marker = '.. ' + marker + '-start'
     end_marker = '.. ' + marker + '-end'
+    build_report.count_file('read')
     for line in path.read_text().split('\n'):
         if line == start_marker:
             if found_start or found_end:
@@ -354,7 +1314,9 @@ def insert_into_file(path, marker, lines):
             rewrite.append(line)
     if not found_start or not found_end:
         sys.exit(f'Invalid markers in {path}')
-    path.write_text('\n'.join(rewrite))
+    text = '\n'.join(rewrite)
+    write_if_changed(path, text, changes)
+    return text
 
 
 def header(title):
@@ -362,7 +1324,7 @@ def header(title):
     return h + title + '\n' + h
 
 
-def write_list_file(path, title, items=[], toc=[], ref=''):
+def write_list_file(path, title, items=[], toc=[], ref='', changes=None):
     lines = [
         ':orphan:',
         '',
@@ -381,37 +1343,63 @@ def write_list_file(path, title, items=[], toc=[], ref=''):
         for item in toc:
             lines.append('    ' + item)
         lines.append('')
-    path.write_text('\n'.join(lines + items))
-
-
-def load_posts(include_drafts=False, verbose=False):
-    for path in posts_path.glob('*/*.rst'):
+    write_if_changed(path, '\n'.join(lines + items), changes)
+
+
+def timed_extract_post_info(path, text):
+    start = time.perf_counter()
+    info = extract_post_info(path, text)
+    return info, time.perf_counter() - start
+
+
+def extract_all_post_info(items, jobs=1):
+    # Returns (title, doc_info) for each (path, text) in the same order
+    if jobs <= 1 or len(items) <= 1:
+        results = [timed_extract_post_info(path, text) for path, text in items]
+    else:
+        chunksize = max(1, len(items) // (jobs * 4))
+        with ProcessPoolExecutor(jobs) as executor:
+            results = list(executor.map(timed_extract_post_info, *zip(*items),
+                chunksize=chunksize))
+    for (path, text), (info, elapsed) in zip(items, results):
+        build_report.parse_times[str(path)] = elapsed
+    return [info for info, elapsed in results]
+
+
+def load_posts(include_drafts=False, verbose=False, cache_path=None, jobs=1):
+    blog = Blog()
+    cache = PostCache(cache_path)
+
+    # Get metadata from the cache or parse the posts that aren't in it. Posts
+    # are always in the same order so the result doesn't depend on which are
+    # cached or how many jobs there are.
+    posts = []
+    to_parse = []
+    for path in sorted(posts_path.glob('*/*.rst')):
         if path.name == 'index.rst':
             continue
+        text = path.read_text()
+        build_report.count_file('read')
+        info = cache.get(path, hash_text(text))
+        if info is None:
+            to_parse.append((path, text))
+        posts.append((path, info))
+    with build_report.phase('parse'):
+        parsed = dict(zip(
+            [path for path, text in to_parse], extract_all_post_info(to_parse, jobs)))
+
+    for path, info in posts:
         if verbose:
             print(path)
-        rst_doc = parse_rst(path)
-        dom = rst_doc.asdom()
-
-        # Get title
-        title = None
-        for title_node in dom.getElementsByTagName('title'):
-            title = get_text([title_node])
-            break
+        if info is None:
+            info = parsed[path]
+        title, doc_info = info
         if verbose:
             print(' ', title)
         if title is None:
             sys.exit('ERROR: post is missing title')
 
-        # Get doc_info (metadata)
-        doc_info = {}
-        for field_list in dom.getElementsByTagName('field_list'):
-            for field in field_list.childNodes:
-                name = get_text(field.getElementsByTagName('field_name'))
-                value = get_text(field.getElementsByTagName('field_body'))
-                doc_info[name] = value
-
-        post = Post(path, title, doc_info, include_drafts=include_drafts)
+        post = blog.add_post(path, title, doc_info, include_drafts=include_drafts)
         if verbose:
             print(' ', post.link)
         if not post.draft and post.published is not None and post.path.parent.name != str(post.published.year):
@@ -427,16 +1415,26 @@ def load_posts(include_drafts=False, verbose=False):
                 sys.exit('ERROR: post to publish is missing summary')
 
         # Write post info back
-        insert_into_file(path, 'post-info', post.post_info(for_post=True))
+        with build_report.phase('insert_into_file'):
+            text = insert_into_file(path, 'post-info', post.post_info(for_post=True))
+        cache.set(path, hash_text(text), title, doc_info)
+
+    cache.save()
+    if cache_path is not None:
+        log(f'Post cache: {cache.hits} hit(s), {cache.misses} miss(es)')
+    return blog
 
 
 def new_post(title):
-    load_posts(include_drafts=True)
+    # Only the file names are checked, so nothing has to be parsed
+    slug = slugify(title)
     year_path = posts_path / str(now.year)
+    path = year_path / (slug + '.rst')
+    for existing in posts_path.glob(f'*/{slug}.rst'):
+        if existing == path:
+            sys.exit(f'{repr(title)} would go to {path}, which already exists!')
+        sys.exit(f'{repr(title)} would go to {path}, but {existing} has the same name!')
     year_path.mkdir(exist_ok=True)
-    path = year_path / (slugify(title) + '.rst')
-    if path.exists():
-        sys.exit(f'{repr(title)} would go to {path}, which already exists!')
 
     path.write_text('\n'.join([
         f':created: {now}',
@@ -471,110 +1469,764 @@ def publish_post(post_path):
     post_path.write_text('\n'.join(new_lines))
 
 
-def generate_blog(include_drafts):
+def generate_blog(include_drafts, cache_path=None, jobs=1):
     log('Generating content for blog (tags, recent posts, etc.)...')
 
-    load_posts(include_drafts, verbose=True)
+    with build_report.phase('load_posts'):
+        blog = load_posts(include_drafts, verbose=True, cache_path=cache_path, jobs=jobs)
+
+    with build_report.phase('pages'):
+        changes = write_blog_pages(blog)
+    log('Pages: ' + ', '.join(
+        f'{changes[change]} {change}' for change in ('added', 'updated', 'removed', 'unchanged')))
+
+    return blog
+
+
+def write_blog_pages(blog):
+    changes = Counter()
 
     # Write recent post lists to index.rst
     lines = []
-    for post in Post.get_sorted()[:5]:
+    for post in blog.get_sorted()[:5]:
         lines.extend(post.post_info())
-    insert_into_file(index_path, 'recent-posts', lines)
+    insert_into_file(index_path, 'recent-posts', lines, changes)
 
     # Write posts.rst
     posts_toc = []
-    for year in sorted(Post.get_years(), reverse=True):
+    for year in sorted(blog.get_years(), reverse=True):
         year_path = posts_path / str(year)
         lines = []
         year_toc = []
-        for post in Post.get_sorted(year=year, reverse=False):
+        for post in blog.get_sorted(year=year, reverse=False):
             lines.extend(post.post_info())
             year_toc.append(post.path.name)
-        write_list_file(year_path / 'index.rst', f'Posts in {year}', lines, toc=year_toc)
+        write_list_file(year_path / 'index.rst', f'Posts in {year}', lines, toc=year_toc,
+            changes=changes)
         posts_toc.append(f'{year} <{year}/index>')
-    write_list_file(posts_path / 'index.rst', 'Posts', toc=posts_toc)
+    write_list_file(posts_path / 'index.rst', 'Posts', toc=posts_toc, changes=changes)
+
+    # Remove year indexes for years that don't have any posts anymore
+    year_paths = {posts_path / str(year) / 'index.rst' for year in blog.get_years()}
+    for path in posts_path.glob('*/index.rst'):
+        if path not in year_paths:
+            path.unlink()
+            changes['removed'] += 1
+            build_report.count_file('removed', path)
 
     # Write tags.rst
-    if tags_path.is_dir():
-        rmtree(tags_path)
-    tags_path.mkdir()
     lines = []
     tags_toc = []
-    for tag in Tag.get_sorted():
+    for tag in blog.get_sorted_tags():
         lines.append(tag.ref + ' ' + str(len(tag.posts)) + ' post(s)')
         lines.append('')
         tags_toc.append(str(tags_path / tag.slug))
-    write_list_file(tags_path.with_suffix('.rst'), 'Tags', lines, toc=tags_toc)
+    write_list_file(tags_path.with_suffix('.rst'), 'Tags', lines, toc=tags_toc,
+        changes=changes)
+
+    # Remove tags/*.rst for tags that don't exist anymore
+    tags_path.mkdir(exist_ok=True)
+    tag_paths = {(tags_path / tag.slug).with_suffix('.rst') for tag in blog.tags.values()}
+    for path in tags_path.glob('*.rst'):
+        if path not in tag_paths:
+            path.unlink()
+            changes['removed'] += 1
+            build_report.count_file('removed', path)
 
     # Write tags/*.rst
-    for tag in Tag.all_tags.values():
+    for tag in blog.tags.values():
         lines = []
-        for post in Post.get_sorted(posts=tag.posts):
+        for post in blog.get_sorted(tag=tag):
             lines.extend(post.post_info())
         write_list_file((tags_path / tag.slug).with_suffix('.rst'),
-            tag.name, lines, ref=tag.ref_name)
+            tag.name, lines, ref=tag.ref_name, changes=changes)
+
+    return changes
+
+
+directive_name_re = re.compile(r'^\s*\.\. ([\w:+-]+)::', re.M)
+role_name_re = re.compile(r':([\w:+-]+):`')
+url_re = re.compile(r'https?://[^\s<>`]+')
+stand_ins = None
+
+
+def get_stand_ins():
+    # A directive and role to stand in for the ones only Sphinx and its
+    # extensions, like sphinx_design's card and dropdown, know about. Without
+    # them docutils skips what's inside. URLs in options, like card's :link:,
+    # and in roles, like :bdg-link-primary:, become references.
+    global stand_ins
+    if stand_ins is None:
+        import docutils.nodes
+        from docutils.parsers.rst import Directive, directives
+
+        def references(text):
+            return [docutils.nodes.reference(uri, uri, refuri=uri) for uri in url_re.findall(text)]
+
+        class AnyOptions(dict):
+            def __missing__(self, key):
+                return directives.unchanged
+
+        class StandInDirective(Directive):
+            has_content = True
+            optional_arguments = 1
+            final_argument_whitespace = True
+            option_spec = AnyOptions(name=directives.unchanged)
+
+            def run(self):
+                node = docutils.nodes.container()
+                if self.arguments:
+                    text_nodes, messages = self.state.inline_text(self.arguments[0], self.lineno)
+                    node += docutils.nodes.paragraph('', '', *text_nodes)
+                    node += messages
+                for value in self.options.values():
+                    node.extend(references(value or ''))
+                self.state.nested_parse(self.content, self.content_offset, node)
+                return [node]
+
+        def stand_in_role(name, rawtext, text, lineno, inliner, options={}, content=[]):
+            return references(text) or [docutils.nodes.inline(rawtext, text)], []
+
+        stand_ins = StandInDirective, stand_in_role
+    return stand_ins
+
+
+def register_stand_ins(text):
+    # Registers the stand ins for the directives and roles in text that
+    # docutils doesn't have.
+    from docutils.parsers.rst import directives, roles
+    from docutils.parsers.rst.languages import en
+
+    directive, role = get_stand_ins()
+    for name in set(directive_name_re.findall(text)):
+        if name.lower() not in en.directives:
+            directives.register_directive(name, directive)
+    for name in set(role_name_re.findall(text)):
+        if name.lower() not in en.roles:
+            roles.register_local_role(name, role)
+
+
+def extract_links(path, text):
+    # Returns the external URLs in references, hyperlink targets, and images,
+    # like Sphinx's linkcheck
+    import docutils.nodes
+
+    register_stand_ins(text)
+    rst_doc = parse_rst(path, text)
+    links = set()
+    for node_type, attr in ((docutils.nodes.reference, 'refuri'),
+            (docutils.nodes.target, 'refuri'), (docutils.nodes.image, 'uri')):
+        for node in rst_doc.findall(node_type):
+            uri = node.get(attr, '')
+            if uri.startswith(('http://', 'https://')):
+                links.add(uri)
+    return sorted(links)
+
+
+def page_has_anchor(body, anchor):
+    # Like Sphinx, anchors are ids or names of any element
+    import urllib.parse
+
+    anchor = re.escape(urllib.parse.unquote(anchor))
+    return re.search(rf'''(?<![\w-])(?:id|name)\s*=\s*(?:"{anchor}"|'{anchor}'|{anchor}[\s/>])''',
+        body.decode('utf-8', errors='replace')) is not None
+
+
+class LinkChecker:
+    '''\
+    Checks URLs in a pool of threads, making at most one request at a time to
+    each host with at least host_interval seconds between them.
+    '''
+
+    def __init__(self, workers=linkcheck_workers, host_interval=linkcheck_host_interval,
+            timeout=linkcheck_timeout):
+        self.workers = workers
+        self.host_interval = host_interval
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.host_locks = {}
+        self.last_request = {}
+
+    @contextmanager
+    def host_slot(self, host):
+        with self.lock:
+            host_lock = self.host_locks.setdefault(host, threading.Lock())
+        with host_lock:
+            wait_for = self.last_request.get(host, 0) + self.host_interval - time.monotonic()
+            if wait_for > 0:
+                time.sleep(wait_for)
+            try:
+                yield
+            finally:
+                self.last_request[host] = time.monotonic()
+
+    def request(self, url, method):
+        # Returns the HTTP status code and the body, which is empty for HEAD
+        import urllib.parse
+        import urllib.request
+
+        request = urllib.request.Request(url, method=method,
+            headers={'User-Agent': linkcheck_user_agent})
+        with self.host_slot(urllib.parse.urlparse(url).netloc):
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, response.read()
+
+    def check(self, url):
+        # Returns the status, HTTP status code, and error. Some servers don't
+        # like HEAD, so GET is tried if it fails. Anchors need the page, so
+        # only GET is used for them, except for #! ones that are really paths
+        # for JavaScript, which Sphinx ignores too.
+        import urllib.error
+
+        url, _, anchor = url.partition('#')
+        check_anchor = anchor and not anchor.startswith('!')
+        for method in ('GET',) if check_anchor else ('HEAD', 'GET'):
+            try:
+                code, body = self.request(url, method)
+            except urllib.error.HTTPError as e:
+                if e.code == 429:
+                    return 'rate-limited', e.code, str(e)
+                result = 'broken', e.code, str(e)
+                continue
+            except (urllib.error.URLError, OSError, ValueError) as e:
+                return 'broken', None, str(getattr(e, 'reason', e))
+            if check_anchor and not page_has_anchor(body, anchor):
+                return 'broken', code, f'Anchor {anchor!r} not found'
+            return 'ok', code, None
+        return result
+
+    def check_all(self, urls):
+        with ThreadPoolExecutor(self.workers) as executor:
+            return dict(zip(urls, executor.map(self.check, urls)))
+
+
+def link_ttl(url, status, failures):
+    # Spread out when links expire, so they aren't all checked on the same run
+    jitter = 0.9 + 0.2 * int(hashlib.sha256(url.encode('utf-8')).hexdigest()[:8], 16) / 0xffffffff
+    if status == 'ok':
+        return linkcheck_ok_ttl * jitter
+    if status == 'broken':
+        return min(linkcheck_failed_ttl * 2 ** (failures - 1), linkcheck_ok_ttl) * jitter
+    # Try again next time
+    return 0
+
+
+def check_links(paths, cache_path, report_path, checker=None, now=None):
+    '''\
+    Check the external links in the rst files at paths, and write a report of
+    all of them to report_path as JSON. Results are cached in cache_path and
+    only new links and links whose results expired are checked. Returns the
+    number of broken links.
+    '''
+    if checker is None:
+        checker = LinkChecker()
+    if now is None:
+        now = time.time()
+    cache = {'docs': {}, 'links': {}}
+    if cache_path.is_file():
+        try:
+            cache = json.loads(cache_path.read_text())
+        except ValueError:
+            pass
+        # Links found or checked the old way can't be trusted
+        if cache.get('version') != linkcheck_cache_version:
+            cache = {'docs': {}, 'links': {}}
+
+    # Find the links, only parsing files that changed
+    docs = {}
+    links = {}
+    for path in paths:
+        text = path.read_text()
+        digest = hash_text(text)
+        doc = cache['docs'].get(str(path))
+        if doc is None or doc['hash'] != digest:
+            doc = {'hash': digest, 'links': extract_links(path, text)}
+        docs[str(path)] = doc
+        for link in doc['links']:
+            links.setdefault(link, []).append(str(path))
+
+    to_check = [link for link in sorted(links)
+        if link not in cache['links'] or cache['links'][link]['expires'] <= now]
+    log(f'Checking {len(to_check)} link(s), {len(links) - len(to_check)} cached')
+    results = checker.check_all(to_check)
+
+    entries = {}
+    report = {}
+    for link, link_docs in sorted(links.items()):
+        entry = cache['links'].get(link)
+        cached = link not in results
+        if not cached:
+            status, code, error = results[link]
+            failures = 0
+            if status == 'broken':
+                failures = (entry or {}).get('failures', 0) + 1
+            elif status == 'rate-limited' and entry is not None:
+                failures = entry.get('failures', 0)
+            entry = {
+                'status': status,
+                'code': code,
+                'error': error,
+                'failures': failures,
+                'checked': now,
+                'expires': now + link_ttl(link, status, failures),
+            }
+            if status == 'broken':
+                log(f'Broken link {link} in {", ".join(link_docs)}: {error}', error=True)
+        entries[link] = entry
+        report[link] = dict(entry, cached=cached, docs=link_docs,
+            checked=datetime.fromtimestamp(entry['checked'], timezone.utc).isoformat(),
+            expires=datetime.fromtimestamp(entry['expires'], timezone.utc).isoformat())
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+    tmp_path.write_text(json.dumps(
+        {'version': linkcheck_cache_version, 'docs': docs, 'links': entries}))
+    tmp_path.replace(cache_path)
+
+    counts = Counter(entry['status'] for entry in entries.values())
+    report_path.write_text(json.dumps({
+        'created': datetime.fromtimestamp(now, timezone.utc).isoformat(),
+        'checked': len(results),
+        'cached': len(links) - len(results),
+        'counts': dict(counts),
+        'links': report,
+    }, indent=2) + '\n')
+    log('Links: ' + ', '.join(f'{count} {status}' for status, count in sorted(counts.items())))
+    return counts['broken']
+
+
+def make_server(directory, bind='', port=8000, compressed=None):
+    '''\
+    Returns a threaded HTTP server for directory with ETags, conditional GETs,
+    and compressed variants from compressed if the client accepts them.
+    '''
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and the body are sent separately, don't let Nagle hold them
+        disable_nagle_algorithm = True
+
+        def __init__(self, *args, **kw):
+            super().__init__(*args, directory=directory, **kw)
+
+        def log_message(self, format, *args):
+            log(f'{self.address_string()} - {format % args}')
+
+        def get_variant(self, path):
+            # Returns the path and encoding of what to send for path
+            if compressed is not None:
+                accepted = accepted_encodings(self.headers.get('Accept-Encoding', ''))
+                key = str(path.relative_to(directory))
+                for encoding in compressed_suffixes:
+                    if encoding not in accepted:
+                        continue
+                    try:
+                        variant = get_variant(compressed, key, encoding, path.stat().st_mtime_ns)
+                    except FileNotFoundError:
+                        break
+                    if variant is not None:
+                        return variant, encoding
+            return path, None
+
+        def not_modified(self, etag, mtime):
+            if 'If-None-Match' in self.headers:
+                tags = [tag.strip() for tag in self.headers['If-None-Match'].split(',')]
+                return etag in tags or '*' in tags
+            if 'If-Modified-Since' in self.headers:
+                try:
+                    since = email.utils.parsedate_to_datetime(self.headers['If-Modified-Since'])
+                except (TypeError, ValueError):
+                    return False
+                return since.timestamp() >= int(mtime)
+            return False
+
+        def send_head(self):
+            path = Path(self.translate_path(self.path))
+            if path.is_dir() and self.path.split('?', 1)[0].endswith('/'):
+                path = path / 'index.html'
+            if not path.is_file():
+                # Let the base class do redirects, listings, and errors
+                return super().send_head()
+
+            send_path, encoding = self.get_variant(path)
+            try:
+                f = send_path.open('rb')
+            except OSError:
+                return super().send_head()
+            st = os.fstat(f.fileno())
+            etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}{"-" + encoding if encoding else ""}"'
+            if self.not_modified(etag, st.st_mtime):
+                f.close()
+                self.send_response(http.HTTPStatus.NOT_MODIFIED)
+                f = None
+            else:
+                self.send_response(http.HTTPStatus.OK)
+                self.send_header('Content-Type', self.guess_type(str(path)))
+                self.send_header('Content-Length', str(st.st_size))
+                if encoding is not None:
+                    self.send_header('Content-Encoding', encoding)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', self.date_time_string(st.st_mtime))
+            if compressed is not None:
+                self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return f
+
+        def copyfile(self, source, outputfile):
+            # Let the kernel copy the file straight to the socket
+            outputfile.flush()
+            self.connection.sendfile(source)
+
+    return http.server.ThreadingHTTPServer((bind, port), Handler)
+
+
+def snapshot_files(paths):
+    # Returns the mtime and size of every file in paths
+    files = {}
+    for path in paths:
+        for file in path.glob('**/*') if path.is_dir() else [path]:
+            try:
+                st = file.stat()
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                files[file] = (st.st_mtime_ns, st.st_size)
+    return files
+
+
+def wait_for_changes(paths, files, interval=0.5, settle=0.3):
+    # Poll until something changes, then keep going until it stops changing for
+    # a bit so a burst of writes only causes one rebuild. Returns the changed
+    # paths and the new snapshot.
+    while True:
+        time.sleep(interval)
+        current = snapshot_files(paths)
+        if current != files:
+            break
+    while True:
+        time.sleep(settle)
+        later = snapshot_files(paths)
+        if later == current:
+            break
+        current = later
+    changed = {path for path in files.keys() | current.keys() if files.get(path) != current.get(path)}
+    return changed, current
+
+
+# Runs in the venv and does sphinx-build commands it reads from stdin, writing
+# the results to the file descriptor it's given.
+sphinx_worker_code = '''\
+import sys, os, json, time
+results = os.fdopen(int(sys.argv[1]), 'w')
+import sphinx.cmd.build
+print(json.dumps({'ready': True}), file=results, flush=True)
+for line in sys.stdin:
+    start = time.perf_counter()
+    try:
+        status = sphinx.cmd.build.main(json.loads(line))
+    except SystemExit as e:
+        status = e.code
+    elapsed = time.perf_counter() - start
+    print(json.dumps({'status': status, 'time': elapsed}), file=results, flush=True)
+'''
+
+
+class SphinxWorker:
+    # Keeps Sphinx and the extensions imported between builds, so they're only
+    # loaded once instead of once per sphinx-build.
+    def __init__(self, doc_env):
+        start = time.perf_counter()
+        results_r, results_w = os.pipe()
+        cmd = [str(doc_env.bin_path / 'python'), '-c', sphinx_worker_code, str(results_w)]
+        log('Starting Sphinx worker')
+        self.proc = Popen(cmd, stdin=PIPE, text=True, env=doc_env.get_env(), cwd=abs_root,
+            pass_fds=(results_w,))
+        os.close(results_w)
+        self.results = os.fdopen(results_r)
+        self.read_result()
+        self.startup_time = time.perf_counter() - start
+        log(f'Sphinx worker took {self.startup_time:.2f} s to start')
+        self.builds = 0
+
+    def read_result(self):
+        line = self.results.readline()
+        if not line:
+            sys.exit('ERROR: Sphinx worker exited unexpectedly')
+        return json.loads(line)
+
+    def build(self, *args):
+        log('Running', repr(' '.join(('sphinx-build',) + args)), 'in worker')
+        self.proc.stdin.write(json.dumps(args) + '\n')
+        self.proc.stdin.flush()
+        result = self.read_result()
+        msg = f'sphinx-build took {result["time"]:.2f} s'
+        if self.builds:
+            # The first build pays for importing the extensions
+            msg += f', saved at least {self.startup_time:.2f} s of startup'
+        log(msg)
+        self.builds += 1
+        if result['status']:
+            raise CalledProcessError(result['status'], ('sphinx-build',) + args)
+
+    def close(self):
+        # Ends the worker once it's done with what it was sent
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        status = self.proc.wait()
+        self.results.close()
+        if status:
+            log(f'Sphinx worker exited with status {status}', error=True)
+
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise ArgumentTypeError(f'has to be a positive number, not {value!r}')
+    return number
+
+
+def jobs_arg(value):
+    if value == 'auto':
+        return value
+    try:
+        return positive_int(value)
+    except ArgumentTypeError:
+        raise ArgumentTypeError(f'has to be a positive number or auto, not {value!r}')
+
+
+def action(deps=[], inputs=None, outputs=None, values=None):
+    '''\
+    Declare a DocEnv action's dependencies, which are run first, and inputs and
+    outputs, which are methods that return lists of paths. Actions with inputs
+    are skipped if the inputs, the values method's result, and blog.py are the
+    same as the last time it ran and the outputs are all there.
+    '''
+    def decorate(func):
+        func.deps = deps
+        func.inputs = inputs
+        func.outputs = outputs
+        func.values = values
+        return func
+    return decorate
+
+
+def input_files(paths):
+    # Returns every file in paths, looking inside directories
+    files = []
+    for path in paths:
+        if path.is_dir():
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = [d for d in dirnames if d != '__pycache__']
+                files.extend(Path(dirpath) / name for name in filenames)
+        elif path.exists():
+            files.append(path)
+    return sorted(files)
+
+
+def inputs_hash(paths, values=None):
+    # Files are compared by mtime and size, like make does
+    h = hashlib.sha256(repr(values).encode('utf-8'))
+    for path in input_files(paths + [Path(__file__)]):
+        st = path.stat()
+        h.update(f'{path}\0{st.st_mtime_ns}\0{st.st_size}\n'.encode('utf-8'))
+    return h.hexdigest()
 
 
 class DocEnv:
-    def __init__(self, venv_path, build_path, drafts):
+    def __init__(self, venv_path, build_path, drafts, cache=True, sphinx_worker=False):
         self.venv_path = Path(venv_path)
         self.abs_venv_path = self.venv_path.resolve()
         self.bin_path = self.abs_venv_path / 'bin'
+        self.venv_stamp_path = self.abs_venv_path / 'blog-stamp.json'
         self.build_path = Path(build_path)
         self.abs_build_path = self.build_path.resolve()
         self.html_output = self.abs_build_path / 'html'
+        self.compressed_output = self.abs_build_path / 'compressed'
+        self.image_cache = self.abs_build_path / 'images'
+        self.report_path = self.abs_build_path / 'report.json'
+        self.profile_path = self.abs_build_path / 'profile.prof'
+        self.stamps_path = self.abs_build_path / 'stamps'
+        self.post_cache_path = self.abs_build_path / 'post-cache.json' if cache else None
         self.drafts = drafts
+        self.jobs = 1
+        self.wait_for_cdn = False
+        self.wildcard_threshold = cf_wildcard_threshold
+        self.distribution = cf_distribution_id
+        self.dry_run = False
+        self.offline = False
+        self.force = False
+        self.serial = False
+        self.bind = ''
+        self.port = 8000
+        self.use_sphinx_worker = sphinx_worker
+        self.sphinx_worker = None
+        # Sphinx builds share _build/doctrees and the worker's pipe, so only
+        # one runs at a time even when actions run in threads.
+        self.sphinx_lock = threading.Lock()
         self.done = set()
 
-    def run(self, *cmd, cwd=abs_root):
+    def get_env(self):
         env = os.environ.copy()
         env['VIRUTAL_ENV'] = str(self.abs_venv_path)
         env['PATH'] = str(self.bin_path) + os.pathsep + env['PATH']
+        return env
+
+    def run(self, *cmd, cwd=abs_root):
         log('Running', repr(' '.join(cmd)), 'in', repr(str(cwd)))
-        check_call(cmd, env=env, cwd=cwd)
+        check_call(cmd, env=self.get_env(), cwd=cwd)
 
     def rm_build(self):
         if self.build_path.is_dir():
             log('build.py: Removing existing {}...'.format(self.build_path))
             rmtree(self.build_path)
 
+    def read_venv_stamp(self):
+        try:
+            return json.loads(self.venv_stamp_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def sphinx_version(self):
+        try:
+            return check_output([str(self.bin_path / 'python'), '-c',
+                'import sphinx; print(sphinx.__version__)'], text=True).strip()
+        except (OSError, CalledProcessError):
+            return None
+
     def setup(self, force_new=False):
+        # The venv is up to date if the stamp in it has the same requirements
+        # and interpreter. Usually requirements.txt hasn't been touched since,
+        # so it doesn't even need to be read.
         sanity_path = self.bin_path / 'sphinx-build'
-        install_deps = False
-        if force_new or not self.venv_path.is_dir():
+        python_version = f'{sys.implementation.name}-{platform.python_version()}'
+        st = reqs_path.stat()
+        reqs_stat = [st.st_mtime_ns, st.st_size]
+        stamp = None if force_new else self.read_venv_stamp()
+        if stamp is not None and stamp['python'] == python_version and sanity_path.is_file():
+            if stamp['requirements_stat'] == reqs_stat:
+                return
+            reqs_hash = hashlib.sha256(reqs_path.read_bytes()).hexdigest()
+            if stamp['requirements'] == reqs_hash:
+                # Touched, like by a checkout, but not changed
+                stamp['requirements_stat'] = reqs_stat
+                self.venv_stamp_path.write_text(json.dumps(stamp))
+                return
+
+        old_sphinx = stamp['sphinx'] if stamp is not None else None
+        if old_sphinx is None and sanity_path.is_file():
+            old_sphinx = self.sphinx_version()
+        if force_new or not self.venv_path.is_dir() or \
+                (stamp is not None and stamp['python'] != python_version):
             log('Creating venv...')
             venv.create(self.venv_path, clear=True, with_pip=True)
-            install_deps = True
-        elif reqs_path.stat().st_mtime >= self.venv_path.stat().st_mtime:
+        elif stamp is not None and sanity_path.is_file():
             log('Requirements file was changed, updating dependencies.')
-            install_deps = True
         elif not sanity_path.is_file():
             log('sphinx-build not found, need to install dependencies?')
-            install_deps = True
-
-        if install_deps:
-            log('Install Dependencies...')
-            self.run('python', '-m', 'pip', 'install', '-r', str(reqs_path))
-            if not sanity_path.is_file():
-                log('sphinx-build not found after installing dependencies', error=True)
-                sys.exit(1)
-            self.venv_path.touch()
+
+        log('Install Dependencies...')
+        if not self.offline:
+            self.run('python', '-m', 'pip', 'wheel', '-r', str(reqs_path),
+                '--wheel-dir', str(wheel_cache_path), '--find-links', str(wheel_cache_path))
+        self.run('python', '-m', 'pip', 'install', '-r', str(reqs_path),
+            '--no-index', '--find-links', str(wheel_cache_path))
+        if not sanity_path.is_file():
+            log('sphinx-build not found after installing dependencies', error=True)
+            sys.exit(1)
+
+        # Only throw away the build if it might not work with the new Sphinx
+        sphinx = self.sphinx_version()
+        if old_sphinx is None or sphinx is None or \
+                old_sphinx.split('.')[0] != sphinx.split('.')[0]:
+            log(f'Sphinx changed from {old_sphinx} to {sphinx}')
             self.rm_build()
+        self.venv_stamp_path.write_text(json.dumps({
+            'python': python_version,
+            'requirements': hashlib.sha256(reqs_path.read_bytes()).hexdigest(),
+            'requirements_stat': reqs_stat,
+            'sphinx': sphinx,
+        }))
+
+    def post_jobs(self):
+        return (os.cpu_count() or 1) if self.jobs == 'auto' else self.jobs
+
+    def sphinx_build(self, builder, *args, jobs=None, build_path=None):
+        if jobs is None:
+            jobs = self.jobs
+        if build_path is None:
+            build_path = self.abs_build_path
+        args = ('-M', builder, '.', str(build_path)) + args
+        if jobs != 1:
+            args += ('-j', str(jobs))
+        with self.sphinx_lock, build_report.phase('sphinx-build ' + builder):
+            if self.use_sphinx_worker:
+                if self.sphinx_worker is None:
+                    self.sphinx_worker = SphinxWorker(self)
+                self.sphinx_worker.build(*args)
+            else:
+                self.run('sphinx-build', *args)
 
-    def sphinx_build(self, builder, *args):
-        args = list(args)
-        self.run('sphinx-build', '-M', builder, '.', str(self.abs_build_path), *args)
+    def stop_sphinx_worker(self):
+        if self.sphinx_worker is not None:
+            self.sphinx_worker.close()
+            self.sphinx_worker = None
 
     def do(self, actions, because_of=None, open_result=False):
+        # Put dependencies before the actions that need them
+        order = []
+
+        def add(action, needed_by):
+            if action not in order:
+                for dep in getattr(self, 'do_' + action).deps:
+                    add(dep, action)
+                order.append(action)
+                if action not in self.done:
+                    log('Doing', action, ('needed by ' + needed_by) if needed_by else '')
+
         for action in actions:
-            log('Doing', action, ('needed by ' + because_of) if because_of else '')
-            if action in self.done:
-                log(action, 'already done')
-                continue
-            result_path = getattr(self, 'do_' + action)()
-            self.done |= {action,}
-            if open_result:
+            add(action, because_of)
+
+        # Run the actions as soon as what they need is done. If more than one
+        # can run at once they're run in threads, otherwise in this thread so
+        # things like serve can be interrupted. Serially they're all run in
+        # this thread, which is what cProfile sees.
+        pending = [action for action in order if action not in self.done]
+        running = {}
+        results = {}
+        try:
+            with ThreadPoolExecutor() as executor:
+                while pending or running:
+                    ready = [action for action in pending
+                        if all(dep in self.done for dep in getattr(self, 'do_' + action).deps)]
+                    if self.serial:
+                        ready = ready[:1]
+                    for action in ready:
+                        pending.remove(action)
+                    if len(ready) == 1 and not running:
+                        results[ready[0]] = self.run_action(ready[0])
+                        self.done |= {ready[0],}
+                        continue
+                    for action in ready:
+                        running[executor.submit(self.run_action, action)] = action
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        action = running.pop(future)
+                        results[action] = future.result()
+                        self.done |= {action,}
+        finally:
+            if because_of is None:
+                self.stop_sphinx_worker()
+                for action, info in build_report.actions.items():
+                    log(f'{action}: {info["status"]} in {info["wall"]:.2f} s')
+                build_report.write(self.report_path)
+
+        if open_result:
+            for action in actions:
+                result_path = results.get(action)
                 if result_path is None:
                     log('Can\'t open', action, 'result')
                 else:
@@ -582,101 +2234,296 @@ class DocEnv:
                     log('Opening', uri)
                     webbrowser.open(uri)
 
+    def run_action(self, action):
+        # Returns what the action returned, or returned last time if it's up
+        # to date.
+        func = getattr(self, 'do_' + action)
+        start = time.perf_counter()
+        stamp_path = self.stamps_path / (action + '.json')
+        if func.inputs is not None:
+            values = None if func.values is None else func.values(self)
+            stamp = None
+            if not self.force and stamp_path.is_file():
+                stamp = json.loads(stamp_path.read_text())
+            if stamp is not None and stamp['inputs'] == inputs_hash(func.inputs(self), values) \
+                    and all(path.exists() for path in func.outputs(self)):
+                log(action, 'is up to date')
+                build_report.actions[action] = {
+                    'status': 'skipped', 'wall': round(time.perf_counter() - start, 6)}
+                return None if stamp['result'] is None else Path(stamp['result'])
+
+        with build_report.phase(action):
+            result_path = func()
+        build_report.actions[action] = {
+            'status': 'done', 'wall': round(time.perf_counter() - start, 6)}
+        if func.inputs is not None:
+            # Hashed after running, because blog writes to its own inputs
+            stamp_path.parent.mkdir(parents=True, exist_ok=True)
+            stamp_path.write_text(json.dumps({
+                'inputs': inputs_hash(func.inputs(self), values),
+                'result': None if result_path is None else str(result_path),
+            }))
+        return result_path
+
     @classmethod
     def all_actions(cls):
         return [k[3:] for k, v in vars(cls).items() if k.startswith('do_')]
 
+    @action(deps=['blog'])
     def do_strict(self):
         self.sphinx_build('dummy', '-W')
-        self.sphinx_build('linkcheck')
+        rst_paths = sorted(posts_path.glob('**/*.rst')) + sorted(Path('.').glob('*.rst'))
+        report_path = self.abs_build_path / 'linkcheck.json'
+        broken = check_links(rst_paths, self.abs_build_path / 'linkcheck-cache.json', report_path)
+        if broken:
+            sys.exit(f'ERROR: {broken} broken link(s), see {report_path}')
         return None
 
+    @action(
+        inputs=lambda self: [font_path],
+        outputs=lambda self: [static_path / 'logo-light.png', static_path / 'logo-dark.png',
+            direct_copy_path / 'browserconfig.xml', direct_copy_path / 'site.webmanifest'] +
+            [direct_copy_path / name for name in icon_files],
+        values=lambda self: [name, theme_fg_hex, theme_bg_hex, icons_version],
+    )
     def do_icons(self):
-        generate_icons()
+        generate_icons(self.abs_build_path / 'icons.stamp')
 
+    @action(
+        inputs=lambda self: [posts_path, index_path],
+        outputs=lambda self: [posts_path / 'index.rst', tags_path.with_suffix('.rst'), tags_path],
+        values=lambda self: [self.drafts, self.post_cache_path is not None],
+    )
     def do_blog(self):
-        generate_blog(self.drafts)
+        generate_blog(self.drafts, cache_path=self.post_cache_path, jobs=self.post_jobs())
         return None
 
-    def do_html(self):
-        self.do(['blog'], because_of='html')
+    def build_html(self):
+        with build_report.phase('images'):
+            images = make_post_images(self.image_cache)
         self.sphinx_build('html')
+        with build_report.phase('srcsets'):
+            add_image_srcsets(self.html_output, self.image_cache, images)
+        log('Compressing...')
+        with build_report.phase('compress'):
+            compress_site(self.html_output, self.compressed_output)
+
+    @action(
+        deps=['icons', 'blog'],
+        inputs=lambda self: [abs_root / 'conf.py', reqs_path, templates_path, static_path,
+            direct_copy_path, tags_path, posts_path] + sorted(abs_root.glob('*.rst')),
+        outputs=lambda self: [self.html_output / 'index.html', self.compressed_output],
+    )
+    def do_html(self):
+        self.build_html()
         return self.html_output / 'index.html'
 
+    def blog_sources(self):
+        # What generate_blog writes
+        paths = [index_path, posts_path / 'index.rst', tags_path.with_suffix('.rst')]
+        paths += sorted(posts_path.glob('*/index.rst')) + sorted(tags_path.glob('*.rst'))
+        return {str(path): path.read_bytes() for path in paths if path.is_file()}
+
+    @action(deps=['icons'])
+    def do_compare_jobs(self):
+        '''\
+        Check that generating the blog and building the HTML give the same
+        results serially and with --jobs (or auto if it's 1), and how much
+        faster it is. HTML is built from scratch into _build/jobs-1 and
+        _build/jobs-N. The results go to _build/jobs-report.json.
+        '''
+        jobs = 'auto' if self.jobs == 1 else self.jobs
+        report = {'jobs': jobs, 'cpus': os.cpu_count(), 'times': {}, 'differences': {}}
+
+        # Generated blog sources. It's generated once first so both timings
+        # start with docutils imported and the files written.
+        generate_blog(self.drafts, jobs=1)
+        sources = {}
+        post_jobs = (os.cpu_count() or 1) if jobs == 'auto' else jobs
+        for label, post_jobs in (('serial', 1), ('parallel', post_jobs)):
+            start = time.perf_counter()
+            generate_blog(self.drafts, jobs=post_jobs)
+            report['times'][f'blog {label}'] = time.perf_counter() - start
+            sources[label] = self.blog_sources()
+        report['differences']['blog'] = sorted(path
+            for path in sources['serial'].keys() | sources['parallel'].keys()
+            if sources['serial'].get(path) != sources['parallel'].get(path))
+
+        # HTML, including what the extensions add. Sphinx warns and builds
+        # serially if an extension isn't parallel safe, so warnings are kept.
+        outputs = {}
+        for label, sphinx_jobs in (('serial', 1), ('parallel', jobs)):
+            build_path = self.abs_build_path / f'jobs-{sphinx_jobs}'
+            if build_path.is_dir():
+                rmtree(build_path)
+            warnings_path = build_path / 'warnings.txt'
+            build_path.mkdir(parents=True)
+            start = time.perf_counter()
+            self.sphinx_build('html', '-w', str(warnings_path), jobs=sphinx_jobs, build_path=build_path)
+            report['times'][f'html {label}'] = time.perf_counter() - start
+            report[f'warnings {label}'] = warnings_path.read_text().splitlines()
+            html_path = build_path / 'html'
+            outputs[label] = {str(path.relative_to(html_path)): path
+                for path in html_path.glob('**/*') if path.is_file()}
+        report['differences']['html'] = sorted(path
+            for path in outputs['serial'].keys() | outputs['parallel'].keys()
+            if path not in outputs['serial'] or path not in outputs['parallel'] or
+                outputs['serial'][path].read_bytes() != outputs['parallel'][path].read_bytes())
+
+        for kind in ('blog', 'html'):
+            report[f'{kind} speedup'] = \
+                report['times'][f'{kind} serial'] / report['times'][f'{kind} parallel']
+            log(f'{kind}: {report["times"][f"{kind} serial"]:.2f} s serially, '
+                f'{report["times"][f"{kind} parallel"]:.2f} s with {jobs} jobs '
+                f'({report[f"{kind} speedup"]:.2f}x), '
+                f'{len(report["differences"][kind])} file(s) differ')
+        report_path = self.abs_build_path / 'jobs-report.json'
+        report_path.write_text(json.dumps(report, indent=2) + '\n')
+        if report['differences']['blog'] or report['differences']['html']:
+            sys.exit(f'ERROR: Results differ with {jobs} jobs, see {report_path}')
+        return None
+
+    @action(deps=['html'])
     def do_serve(self):
-        self.do(['html'], because_of='serve')
-        html_output = self.html_output
-        class Handler(http.server.SimpleHTTPRequestHandler):
-            def __init__(self, *args, **kw):
-                super().__init__(*args, directory=html_output, **kw)
-
-        port = 8000
-        with socketserver.TCPServer(("", port), Handler) as httpd:
-            print(f'Serving http://127.0.0.1:{port}')
+        with self.make_server() as httpd:
+            print(f'Serving {self.server_url(httpd)}')
             httpd.serve_forever()
 
-
+    @action(deps=['html'])
+    def do_watch(self):
+        with self.make_server() as httpd:
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            print(f'Serving {self.server_url(httpd)}')
+            files = snapshot_files(watch_paths)
+            while True:
+                log('Watching for changes...')
+                changed, files = wait_for_changes(watch_paths, files)
+                for path in sorted(changed):
+                    log('Changed', path)
+                self.rebuild(changed)
+                # Don't count what the rebuild wrote as changes, but keep what
+                # was there before it for everything else, so files saved
+                # during the rebuild cause another one.
+                current = snapshot_files(watch_paths)
+                for path in build_report.changed_paths:
+                    if path in current:
+                        files[path] = current[path]
+                    else:
+                        files.pop(path, None)
+
+    def make_server(self):
+        return make_server(self.html_output, self.bind, self.port, compressed=self.compressed_output)
+
+    def server_url(self, httpd):
+        host = self.bind if self.bind not in ('', '0.0.0.0') else '127.0.0.1'
+        return f'http://{host}:{httpd.server_address[1]}'
+
+    def rebuild(self, changed):
+        # Redo what depends on the changed files, without letting a broken post
+        # or build stop the watch.
+        start = time.perf_counter()
+        build_report.reset()
+        try:
+            with build_report.phase('rebuild'):
+                if any(path == index_path or posts_path in path.parents for path in changed):
+                    with build_report.phase('blog'):
+                        generate_blog(self.drafts, cache_path=self.post_cache_path,
+                            jobs=self.post_jobs())
+                    blog_done = time.perf_counter()
+                    log(f'Blog took {blog_done - start:.2f} s')
+                else:
+                    blog_done = start
+                self.build_html()
+                log(f'HTML took {time.perf_counter() - blog_done:.2f} s')
+        except SystemExit as e:
+            log('Rebuild failed:', e, error=True)
+        except Exception as e:
+            # Like a half typed date or an image that's still being written.
+            # Keep watching, since the next change will probably fix it.
+            log('Rebuild failed:', f'{type(e).__name__}: {e}', error=True)
+        build_report.write(self.report_path)
+        log(f'Rebuild took {time.perf_counter() - start:.2f} s')
+
+    @action()
     def do_upload(self):
-        self.rm_build()
-        self.drafts = False
-        self.do(['html'], because_of='upload')
-
-        log('Uploading...')
+        manifest_path = self.abs_build_path / 'deploy-manifest.json'
+        if self.dry_run:
+            if not self.html_output.is_dir():
+                sys.exit(f'ERROR: {self.html_output} has to be built first for a dry run')
+            log('Planning upload of existing build...')
+        else:
+            self.drafts = False
+            self.do(['html'], because_of='upload')
+            prune_stale_html(self.html_output)
+            log('Uploading...')
+
+        # Compare the build to what was deployed last time
+        previous = load_manifest(manifest_path)
+        manifest = build_manifest(self.html_output, previous or {}, self.compressed_output)
+        s3 = None
+        if previous is None:
+            if self.dry_run:
+                log('No deploy manifest, assuming the bucket is empty')
+                previous = {}
+            else:
+                log('No deploy manifest, comparing with the bucket contents')
+                s3 = self.s3_client()
+                previous = list_s3_objects(s3, url)
+        to_upload, to_delete = plan_sync(manifest, previous)
+        batches = plan_invalidation(to_upload + to_delete, threshold=self.wildcard_threshold)
+        log(f'{len(to_upload)} to upload, {len(to_delete)} to delete, '
+            f'{len(manifest) - len(to_upload)} unchanged, '
+            f'{sum(len(batch) for batch in batches)} path(s) to invalidate')
+
+        if self.dry_run:
+            for key in to_upload:
+                print('upload', key, manifest[key]['content_type'])
+            for key in to_delete:
+                print('delete', key)
+            for batch in batches:
+                print('invalidate', ' '.join(batch))
+            return
 
-        import boto3
+        if not (to_upload or to_delete):
+            write_if_changed(manifest_path, json.dumps(manifest, indent=1))
+            log('Nothing changed')
+            return
 
-        # Get files and MIME types
-        files = []
-        for path in self.html_output.glob('**/*'):
-            if not path.is_file():
-                continue
-            files.append((path, str(path.relative_to(self.html_output)), get_mimetype(path)))
-
-        # Replace files on S3
-        s3 = boto3.resource('s3')
-        bucket = s3.Bucket(url)
-        bucket.objects.delete()
-        for path, s3_key, mimetype in files:
-            log('Upload', path)
-            log(f'  to {url}/{s3_key}')
-            log(f'  {mimetype}')
-            bucket.upload_file(str(path), s3_key, ExtraArgs={'ContentType': mimetype})
+        # Sync files to S3
+        if s3 is None:
+            s3 = self.s3_client()
+        sync_to_s3(s3, url, manifest, to_upload, to_delete)
 
         log('Updating CDN...')
 
+        import boto3
+
         # Get Cloudfront Distribution
         cloudfront = boto3.client('cloudfront')
         bucket_origin = url + '.' + aws
-        cf_distro_id = None
-        paginator = cloudfront.get_paginator('list_distributions')
-        page_iterator = paginator.paginate()
-        for page in page_iterator:
-            for distribution in page['DistributionList']['Items']:
-                for cf_origin in distribution['Origins']['Items']:
-                    log('Origin found {}'.format(cf_origin['DomainName']))
-                    if bucket_origin == cf_origin['DomainName']:
-                        cf_distro_id = distribution['Id']
-                        log("The CF distribution ID for {} is {}".format(url, cf_distro_id))
+        cf_distro_id = self.distribution
+        if cf_distro_id is None:
+            cf_distro_id = get_distribution(cloudfront, bucket_origin)
         if cf_distro_id is None:
             sys.exit(f'ERROR: Could not find cloudfront distribution for {url}')
+        log("The CF distribution ID for {} is {}".format(url, cf_distro_id))
 
-        # Invalidate files on Cloudfront CDN
-        # TODO: Only invalidate changed files?
-        s3_keys = list(map(lambda t: '/' + t[1], files))
-        s3_keys.append('/')
-        invalidation_id = cloudfront.create_invalidation(
-            DistributionId=cf_distro_id,
-            InvalidationBatch={
-            'Paths': {
-                'Quantity': len(s3_keys),
-                'Items': s3_keys,
-            },
-            'CallerReference': str(time.time()),
-        })['Invalidation']['Id']
-        log(f'Submitted invalidation {invalidation_id}')
+        # Invalidate changed files on Cloudfront CDN
+        invalidate_cloudfront(cloudfront, cf_distro_id, batches, wait=self.wait_for_cdn)
+
+        # Only record the deploy once it's all done, so a failure means the same
+        # changes are tried again next time.
+        write_if_changed(manifest_path, json.dumps(manifest, indent=1))
 
         log('Done')
 
+    def s3_client(self):
+        import boto3
+        import botocore.config
+
+        return boto3.client('s3',
+            config=botocore.config.Config(max_pool_connections=s3_upload_jobs))
+
 
 if __name__ == '__main__':
     arg_parser = ArgumentParser(description=__doc__)
@@ -692,6 +2539,18 @@ if __name__ == '__main__':
         action='store_true',
         help='Include draft posts'
     )
+    arg_parser.add_argument('--no-cache',
+        action='store_true',
+        help='Parse every post again instead of using cached post metadata'
+    )
+    arg_parser.add_argument('--sphinx-worker',
+        action='store_true',
+        help='Run Sphinx builds in one persistent process instead of a sphinx-build for each'
+    )
+    arg_parser.add_argument('--offline',
+        action='store_true',
+        help='Install dependencies only from the wheels cached in {}'.format(wheel_cache_path)
+    )
     subcmds = arg_parser.add_subparsers(required=True, dest='subcmd')
 
     do_subcmd = subcmds.add_parser('do')
@@ -700,22 +2559,90 @@ if __name__ == '__main__':
         action='store_true',
         help='Open result after building'
     )
+    do_subcmd.add_argument('-j', '--jobs',
+        metavar='N', type=jobs_arg, default=1,
+        help='Number of processes to use for parsing posts and for Sphinx, or auto '
+            'for one per CPU. Default is %(default)s'
+    )
+    do_subcmd.add_argument('-f', '--force',
+        action='store_true',
+        help='Run actions even if they\'re up to date'
+    )
+    do_subcmd.add_argument('--profile',
+        action='store_true',
+        help='Write cProfile stats for the whole run to profile.prof in the build directory. '
+            'Actions are run one at a time so they are all profiled'
+    )
+    do_subcmd.add_argument('--bind',
+        metavar='ADDRESS', default='',
+        help='For serve and watch, the address to listen on. Default is all addresses'
+    )
+    do_subcmd.add_argument('--port',
+        metavar='PORT', type=int, default=8000,
+        help='For serve and watch, the port to listen on. Default is %(default)s'
+    )
+    do_subcmd.add_argument('--dry-run',
+        action='store_true',
+        help='For upload, only print what would be uploaded, deleted, and invalidated'
+    )
+    do_subcmd.add_argument('--wait',
+        action='store_true',
+        help='For upload, wait for the CDN invalidation to finish'
+    )
+    do_subcmd.add_argument('--distribution',
+        metavar='ID', default=cf_distribution_id,
+        help='For upload, the CloudFront distribution ID to use instead of looking it up'
+    )
+    do_subcmd.add_argument('--wildcard-threshold',
+        metavar='N', type=positive_int, default=cf_wildcard_threshold,
+        help='For upload, invalidate a directory with a wildcard if more than N '
+            'files in it changed. Default is %(default)s'
+    )
 
     new_subcmd = subcmds.add_parser('new')
     new_subcmd.add_argument('title', metavar='TITLE')
 
     pub_subcmd = subcmds.add_parser('pub')
-    pub_subcmd.add_argument('post_path', metavar='POST_PATH', type=Path)
+    pub_subcmd.add_argument('post_paths', metavar='POST_PATH', type=Path, nargs='+')
 
     args = arg_parser.parse_args()
-    doc_env = DocEnv(args.venv, args.build, drafts=args.drafts)
-    doc_env.setup()
+    doc_env = DocEnv(args.venv, args.build, drafts=args.drafts, cache=not args.no_cache,
+        sphinx_worker=args.sphinx_worker)
+    doc_env.offline = args.offline
     if args.subcmd == 'do':
-        doc_env.do(args.actions, open_result=args.open)
+        doc_env.setup()
+        doc_env.jobs = args.jobs
+        doc_env.wait_for_cdn = args.wait
+        doc_env.wildcard_threshold = args.wildcard_threshold
+        doc_env.distribution = args.distribution
+        doc_env.dry_run = args.dry_run
+        doc_env.bind = args.bind
+        doc_env.port = args.port
+        doc_env.force = args.force
+        profiler = None
+        if args.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+            # The profiler only sees this thread
+            doc_env.serial = True
+        try:
+            doc_env.do(args.actions, open_result=args.open)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(doc_env.profile_path)
+                log('Wrote profile to', doc_env.profile_path)
     elif args.subcmd == 'new':
         new_post(args.title)
     elif args.subcmd == 'pub':
-        publish_post(args.post_path)
+        for post_path in args.post_paths:
+            if not post_path.is_file():
+                sys.exit(f'ERROR: {post_path} doesn\'t exist')
+        for post_path in dict.fromkeys(args.post_paths):
+            publish_post(post_path)
+        # One build for all of them, which only parses the posts that changed
+        doc_env.setup()
         doc_env.do(['html'])
 
 # vim: expandtab:ts=4:sw=4
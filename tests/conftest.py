@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# blog.py and bench.py are scripts at the top of the repo, not a package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
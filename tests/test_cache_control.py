@@ -0,0 +1,23 @@
+import blog
+
+
+def test_pages_are_revalidated():
+    assert blog.get_cache_control('index.html', 'text/html') == blog.revalidate_cache_control
+    assert blog.get_cache_control('posts/2024/python-3-12-released-20231002.html',
+        'text/html') == blog.revalidate_cache_control
+    assert blog.get_cache_control('_static/page-0123abcd.html',
+        'text/html') == blog.revalidate_cache_control
+
+
+def test_hashed_names_are_immutable():
+    assert blog.get_cache_control('_static/furo.0123abcd.css',
+        'text/css') == blog.immutable_cache_control
+    assert blog.get_cache_control('_images/photo-480w-0123456789ab.webp',
+        'image/webp') == blog.immutable_cache_control
+
+
+def test_other_files():
+    assert blog.get_cache_control('_static/basic.css', 'text/css') == blog.static_cache_control
+    assert blog.get_cache_control('favicon.ico', 'image/x-icon') == blog.default_cache_control
+    assert blog.get_cache_control('searchindex.js',
+        'text/javascript') == blog.revalidate_cache_control
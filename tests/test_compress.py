@@ -0,0 +1,38 @@
+import os
+
+import blog
+
+
+def test_compress_file(tmp_path):
+    html_output = tmp_path / 'html'
+    compressed_path = tmp_path / 'compressed'
+    html_output.mkdir()
+    (html_output / 'page.html').write_text('<p>page</p>' * 100)
+    (html_output / 'tiny.txt').write_text('x')
+    calls = []
+    compressors = {'gzip': lambda data: calls.append(data) or blog.gzip.compress(data, mtime=0)}
+
+    def compress(name):
+        return blog.compress_file(html_output / name, name, compressed_path, compressors)
+
+    size, sizes = compress('page.html')
+    assert size == 1100 and 0 < sizes['gzip'] < 1100 * blog.min_compression_ratio
+    assert compress('tiny.txt') == (1, {})
+    assert len(calls) == 2
+
+    # Neither is compressed again until it changes
+    assert compress('page.html') == (size, sizes)
+    assert compress('tiny.txt') == (1, {})
+    assert len(calls) == 2
+
+    variant = blog.get_variant(compressed_path, 'page.html', 'gzip', 0)
+    assert blog.gzip.decompress(variant.read_bytes()) == (html_output / 'page.html').read_bytes()
+    assert blog.get_variant(compressed_path, 'tiny.txt', 'gzip', 0) is None
+
+    # Stale variants aren't used
+    st = (compressed_path / 'page.html.gz').stat()
+    os.utime(html_output / 'page.html', ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert blog.get_variant(compressed_path, 'page.html', 'gzip',
+        (html_output / 'page.html').stat().st_mtime_ns) is None
+    compress('page.html')
+    assert len(calls) == 3
@@ -0,0 +1,46 @@
+import pytest
+
+import blog
+
+PIL = pytest.importorskip('PIL')
+
+
+@pytest.mark.parametrize('width, widths', [
+    (300, [300]),
+    (960, [480, 960]),
+    (1200, [480, 960, 1200]),
+    (2000, [480, 960, 1440, 2000]),
+])
+def test_image_copy_widths(tmp_path, width, widths):
+    from PIL import Image
+
+    path = tmp_path / 'image.png'
+    Image.new('RGB', (width, 100)).save(path)
+    key, info, new = blog.make_image_copies(path, tmp_path / 'cache')
+    assert new
+    assert info['width'] == width
+    assert sorted({copy_width for suffix, copy_width, name in info['copies']}) == widths
+    for suffix, copy_width, name in info['copies']:
+        assert (tmp_path / 'cache' / key / name).is_file()
+
+    assert blog.make_image_copies(path, tmp_path / 'cache') == (key, info, False)
+
+
+def test_same_image_in_two_posts(tmp_path, monkeypatch):
+    from PIL import Image
+
+    posts_path = tmp_path / 'posts'
+    for year in ('2030', '2031'):
+        (posts_path / year).mkdir(parents=True)
+        Image.new('RGB', (600, 100)).save(posts_path / year / 'image.png')
+        (posts_path / year / 'post.rst').write_text('Post\n====\n\n.. image:: image.png\n')
+    monkeypatch.setattr(blog, 'posts_path', posts_path)
+    made = []
+    make_image_copies = blog.make_image_copies
+    monkeypatch.setattr(blog, 'make_image_copies',
+        lambda path, cache_path: made.append(path) or make_image_copies(path, cache_path))
+
+    images = blog.make_post_images(tmp_path / 'cache', jobs=2)
+    assert len(made) == 1
+    assert len(images) == 1
+    assert [path.name for path in (tmp_path / 'cache').iterdir()] == list(images)
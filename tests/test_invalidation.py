@@ -0,0 +1,41 @@
+import blog
+
+
+def test_keys_become_paths():
+    assert blog.plan_invalidation(['a.html', 'b/c.css']) == [['/a.html', '/b/c.css']]
+
+
+def test_index_html_is_also_invalidated_by_directory_url():
+    assert blog.plan_invalidation(['index.html', 'posts/index.html']) == [
+        ['/', '/index.html', '/posts/', '/posts/index.html']]
+
+
+def test_directory_with_too_many_changes_collapses_to_wildcard():
+    keys = [f'tags/{i}.html' for i in range(11)] + ['about.html']
+    assert blog.plan_invalidation(keys, threshold=10) == [['/about.html', '/tags/*']]
+
+
+def test_collapsed_directories_collapse_again_in_parent():
+    keys = [f'posts/{year}/{i}.html' for year in range(2010, 2013) for i in range(3)]
+    assert blog.plan_invalidation(keys, threshold=2) == [['/posts/*']]
+
+
+def test_threshold_zero_ends():
+    assert blog.plan_invalidation(['x.html'], threshold=0) == [['/*']]
+    assert blog.plan_invalidation(['a/b/c.html', 'd.html'], threshold=0) == [['/*']]
+
+
+def test_batches_have_at_most_max_paths():
+    keys = [f'{i}/page.html' for i in range(2500)]
+    batches = blog.plan_invalidation(keys, threshold=10000)
+    assert [len(batch) for batch in batches] == [1000, 1000, 500]
+    assert sorted(path for batch in batches for path in batch) == \
+        sorted('/' + key for key in keys)
+
+
+def test_batches_have_at_most_max_wildcards():
+    # Each directory has more than the threshold, but / doesn't
+    keys = [f'{d}/{i}.html' for d in range(40) for i in range(50)]
+    batches = blog.plan_invalidation(keys, threshold=45)
+    assert [len(batch) for batch in batches] == [15, 15, 10]
+    assert all(path.endswith('/*') for batch in batches for path in batch)
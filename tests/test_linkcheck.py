@@ -0,0 +1,152 @@
+import json
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+
+import pytest
+
+import blog
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # /ok is fine, /missing is a 404, /nohead only works with GET, and /busy
+    # is rate limited. Pages have an anchor.
+    requests = []
+    body = b'<h2 id="anchor">Anchor</h2><a name=named></a>'
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self):
+        self.requests.append((self.command, self.path))
+        code = {'/missing': 404, '/busy': 429}.get(self.path, 200)
+        if self.path == '/nohead' and self.command == 'HEAD':
+            code = 405
+        body = self.body if code == 200 else b''
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command == 'GET':
+            self.wfile.write(body)
+
+    do_HEAD = respond
+    do_GET = respond
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    StandInHandler.requests = []
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def refused_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    return f'http://127.0.0.1:{port}/refused'
+
+
+def test_extract_links_in_sphinx_directives():
+    text = '''\
+Title
+=====
+
+.. card:: Card
+    :link: https://example.com/card-link
+
+    In a `card <https://example.com/card>`__.
+
+.. dropdown:: Dropdown
+
+    In a `dropdown <https://example.com/dropdown>`__.
+
+.. tab-set::
+
+    .. tab-item:: Tab
+
+        In a `tab <https://example.com/tab>`__ :bdg-link-primary:`badge <https://example.com/badge>`
+
+Outside `out <https://example.com/out>`__ and the target_ and :doc:`about`.
+
+.. image:: https://example.com/image.png
+
+.. figure:: https://example.com/figure.png
+    :target: https://example.com/figure-target
+
+.. _target: https://example.com/target
+'''
+    assert blog.extract_links(Path('test.rst'), text) == [
+        'https://example.com/badge',
+        'https://example.com/card',
+        'https://example.com/card-link',
+        'https://example.com/dropdown',
+        'https://example.com/figure-target',
+        'https://example.com/figure.png',
+        'https://example.com/image.png',
+        'https://example.com/out',
+        'https://example.com/tab',
+        'https://example.com/target',
+    ]
+
+
+def test_check_links(server, tmp_path):
+    refused = refused_url()
+    doc = tmp_path / 'doc.rst'
+    doc.write_text(f'''\
+Title
+=====
+
+`ok <{server}/ok>`__ `missing <{server}/missing>`__ `nohead <{server}/nohead>`__
+`busy <{server}/busy>`__ `refused <{refused}>`__
+`anchor <{server}/ok#anchor>`__ `named <{server}/ok#named>`__ `bang <{server}/ok#!/app>`__
+`no anchor <{server}/ok#nowhere>`__
+''')
+    cache_path = tmp_path / 'cache.json'
+    report_path = tmp_path / 'report.json'
+    checker = blog.LinkChecker(host_interval=0, timeout=5)
+    now = time.time()
+
+    def check(now):
+        StandInHandler.requests = []
+        broken = blog.check_links([doc], cache_path, report_path, checker, now=now)
+        return broken, json.loads(report_path.read_text())['links']
+
+    broken, links = check(now)
+    assert broken == 3
+    assert {link: (info['status'], info['code'], info['cached'])
+            for link, info in links.items()} == {
+        f'{server}/ok': ('ok', 200, False),
+        f'{server}/ok#anchor': ('ok', 200, False),
+        f'{server}/ok#named': ('ok', 200, False),
+        f'{server}/ok#!/app': ('ok', 200, False),
+        f'{server}/ok#nowhere': ('broken', 200, False),
+        f'{server}/missing': ('broken', 404, False),
+        f'{server}/nohead': ('ok', 200, False),
+        f'{server}/busy': ('rate-limited', 429, False),
+        refused: ('broken', None, False),
+    }
+    assert ('GET', '/nohead') in StandInHandler.requests
+    assert StandInHandler.requests.count(('HEAD', '/ok')) == 2
+    assert StandInHandler.requests.count(('GET', '/ok')) == 3
+    assert links[f'{server}/ok']['docs'] == [str(doc)]
+
+    # Only the rate limited link is checked again right away
+    broken, links = check(now + 60)
+    assert broken == 3
+    assert StandInHandler.requests == [('HEAD', '/busy')]
+    assert [link for link, info in links.items() if not info['cached']] == [f'{server}/busy']
+
+    # Broken links expire before ones that were ok
+    broken, links = check(now + blog.linkcheck_failed_ttl * 1.2)
+    assert {link for link, info in links.items() if not info['cached']} == \
+        {f'{server}/missing', f'{server}/ok#nowhere', f'{server}/busy', refused}
+    assert links[f'{server}/missing']['failures'] == 2
+
+    broken, links = check(now + blog.linkcheck_ok_ttl * 1.2)
+    assert not any(info['cached'] for info in links.values())
@@ -0,0 +1,66 @@
+import pytest
+
+import blog
+
+boto3 = pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+bucket = 'bucket'
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=bucket)
+        yield s3
+
+
+def sync(s3, html_output, previous):
+    manifest = blog.build_manifest(html_output, previous)
+    to_upload, to_delete = blog.plan_sync(manifest, previous)
+    blog.sync_to_s3(s3, bucket, manifest, to_upload, to_delete, jobs=2)
+    return manifest, sorted(to_upload), to_delete
+
+
+def test_sync_to_s3(s3, tmp_path):
+    html_output = tmp_path / 'html'
+    (html_output / '_static').mkdir(parents=True)
+    (html_output / 'index.html').write_text('<p>index</p>')
+    (html_output / 'about.html').write_text('<p>about</p>')
+    (html_output / '_static' / 'style.css').write_text('p {}')
+    s3.put_object(Bucket=bucket, Key='orphan.html', Body=b'old')
+
+    # The first sync compares with what's in the bucket, like a deploy without
+    # a manifest
+    manifest, to_upload, to_delete = sync(s3, html_output, blog.list_s3_objects(s3, bucket))
+    assert to_upload == ['_static/style.css', 'about.html', 'index.html']
+    assert to_delete == ['orphan.html']
+    objects = blog.list_s3_objects(s3, bucket)
+    assert sorted(objects) == to_upload
+    for key, entry in manifest.items():
+        assert objects[key] == {'size': entry['size'], 'hash': entry['hash']}
+    obj = s3.get_object(Bucket=bucket, Key='index.html')
+    assert obj['Body'].read() == b'<p>index</p>'
+    assert obj['ContentType'] == 'text/html'
+    assert obj['CacheControl'] == blog.revalidate_cache_control
+
+    # Nothing changed, nothing to do
+    manifest, to_upload, to_delete = sync(s3, html_output, manifest)
+    assert (to_upload, to_delete) == ([], [])
+    assert blog.list_s3_objects(s3, bucket) == objects
+
+    # The same when comparing with the bucket
+    assert blog.plan_sync(manifest, blog.list_s3_objects(s3, bucket)) == ([], [])
+
+    (html_output / 'about.html').write_text('<p>about me</p>')
+    (html_output / '_static' / 'style.css').unlink()
+    manifest, to_upload, to_delete = sync(s3, html_output, manifest)
+    assert to_upload == ['about.html']
+    assert to_delete == ['_static/style.css']
+    assert sorted(blog.list_s3_objects(s3, bucket)) == ['about.html', 'index.html']
+    obj = s3.get_object(Bucket=bucket, Key='about.html')
+    assert obj['Body'].read() == b'<p>about me</p>'